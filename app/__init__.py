@@ -6,10 +6,10 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from config import config
-import os
+from app.replicas import RoutingSession
 
 # Initialize extensions (but don't bind to app yet)
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 
 
@@ -23,39 +23,110 @@ def create_app(config_name='default'):
     # Load configuration
     app.config.from_object(config[config_name])
     
-    # Ensure upload folder exists
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Set up upload storage (local folder or S3-compatible bucket)
+    from app import storage
+    storage.init_app(app)
     
     # Initialize extensions with app
     db.init_app(app)
     login_manager.init_app(app)
     
+    # SQLite pragmas (WAL, busy timeout, ...) for every connection
+    from app import database
+    database.init_app(app)
+    
+    # Read replicas for read-only routes
+    from app import replicas
+    replicas.init_app(app)
+    
+    # Count queries per request (and enforce QUERY_COUNT_LIMIT in debug mode)
+    from app import querycount
+    querycount.init_app(app)
+    
+    # Per-endpoint timings at /metrics (and optional slow-request profiles)
+    from app import metrics
+    metrics.init_app(app)
+    
     # Configure login manager
     login_manager.login_view = 'auth.login'  # Redirect to login page if not authenticated
     login_manager.login_message = 'Please log in to access this page.'
     login_manager.login_message_category = 'info'
     
-    # User loader callback for Flask-Login
-    from app.models import User
+    # Password hashing worker pool
+    from app import passwords
+    passwords.init_app(app)
+    
+    # User loader callback for Flask-Login (cached read-only snapshots)
+    from app import session_user
+    session_user.init_app(app)
     
     @login_manager.user_loader
     def load_user(user_id):
         """Load user by ID for Flask-Login"""
-        return User.query.get(int(user_id))
+        return session_user.load_user(int(user_id))
     
     # Register blueprints (routes)
-    from app.routes import auth, items, messages
+    from app.routes import auth, items, messages, api
     
     app.register_blueprint(auth.bp)
     app.register_blueprint(items.bp)
     app.register_blueprint(messages.bp)
+    app.register_blueprint(api.bp)
     
     # Register main routes (package-level blueprint)
     from app.routes import bp as main_bp
     app.register_blueprint(main_bp)
     
-    # Create database tables
-    with app.app_context():
-        db.create_all()
+    # Check the schema version (tables are created by `flask migrate`)
+    from app import migrations
+    migrations.init_app(app)
+    
+    # Full-text search used by items.browse
+    from app import search
+    search.init_app(app)
+    
+    # Denormalized unread message counters
+    from app import unread
+    unread.init_app(app)
+    
+    # Live unread counts and new-message notifications (Server-Sent Events)
+    from app import events
+    events.init_app(app)
+    
+    # Page cache for anonymous visitors
+    from app import cache
+    cache.init_app(app)
+    
+    # Typeahead suggestion indexes
+    from app import suggest
+    suggest.init_app(app)
+    
+    # Lost-to-found matching index
+    from app import matching
+    matching.init_app(app)
+    
+    # Background job queue and workers
+    from app import jobs
+    jobs.init_app(app)
+    
+    # Bulk import and export commands
+    from app import bulk
+    bulk.init_app(app)
+    
+    # `flask boot-time` command
+    from app import startup
+    startup.init_app(app)
+    
+    # `flask seed-data` and `flask benchmark` commands
+    from app import benchmark
+    benchmark.init_app(app)
+    
+    # `flask check-query-plans` command
+    from app import query_plans
+    query_plans.init_app(app)
+    
+    # `flask archive-items` command
+    from app import archive
+    archive.init_app(app)
     
     return app
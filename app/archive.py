@@ -0,0 +1,136 @@
+"""
+Archiving resolved items
+`flask archive-items` (run it daily, e.g. from cron) moves items resolved
+more than ARCHIVE_AFTER_DAYS ago into items_archive, together with the
+messages about them, and moves their images to cold storage. Their
+conversations and matches are deleted. The items and messages tables and
+their indexes then only hold open and recently resolved items, while the
+detail page of an archived item keeps working from items_archive.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db, unread
+from app.images import delete_variants
+from app.models import (Item, Message, ItemMatch, Conversation, ConversationParticipant,
+                        ItemArchive, MessageArchive)
+from app.storage import get_storage, get_cold_storage, reference_count
+
+logger = logging.getLogger(__name__)
+
+
+def candidates(cutoff, limit):
+    """Ids of items resolved before cutoff, oldest first"""
+    return [row.id for row in db.session.query(Item.id)
+            .filter(Item.is_resolved == db.true(), Item.resolved_at < cutoff)
+            .order_by(Item.resolved_at, Item.id)
+            .limit(limit)]
+
+
+def _copy_to_cold(name):
+    """Copy an image into cold storage unless it is there already; False if it is missing"""
+    cold = get_cold_storage()
+    if cold.exists(name):
+        return True
+    try:
+        with get_storage().open(name) as stream:
+            cold.put(name, stream)
+    except FileNotFoundError:
+        logger.warning('Image %s of an archived item is missing', name)
+        return False
+    return True
+
+
+def _insert_from(archive_model, model, where, now):
+    """INSERT INTO the archive table SELECT the matching rows; returns the row count"""
+    names = [column.name for column in archive_model.__table__.c if column.name != 'archived_at']
+    select = db.select(*[model.__table__.c[name] for name in names], db.literal(now)).where(where)
+    return db.session.execute(db.insert(archive_model).from_select(names + ['archived_at'], select)).rowcount
+
+
+def archive_items(ids):
+    """
+    Move items (and their messages) to the archive tables in one
+    transaction, then drop their images from hot storage.
+    Returns (messages moved, images moved).
+    """
+    now = datetime.utcnow()
+    images = {row.image_filename for row in db.session.query(Item.image_filename)
+              .filter(Item.id.in_(ids), Item.image_filename.isnot(None))}
+
+    # Images are copied first, so a failure below leaves the items intact
+    images = {name for name in images if _copy_to_cold(name)}
+
+    _insert_from(ItemArchive, Item, Item.id.in_(ids), now)
+    conversation_ids = db.select(Conversation.id).where(Conversation.item_id.in_(ids))
+    about = db.or_(Message.item_id.in_(ids), Message.conversation_id.in_(conversation_ids))
+
+    # Unread messages that leave the inbox leave the unread counters too
+    for receiver_id, count in db.session.query(Message.receiver_id, db.func.count(Message.id))\
+            .filter(about, Message.is_read == db.false()).group_by(Message.receiver_id):
+        unread.adjust(receiver_id, -count)
+
+    moved = _insert_from(MessageArchive, Message, about, now)
+    Message.query.filter(about).delete(synchronize_session=False)
+    ConversationParticipant.query.filter(ConversationParticipant.conversation_id.in_(conversation_ids))\
+        .delete(synchronize_session=False)
+    Conversation.query.filter(Conversation.item_id.in_(ids)).delete(synchronize_session=False)
+    ItemMatch.query.filter(db.or_(ItemMatch.item_id.in_(ids), ItemMatch.candidate_id.in_(ids)))\
+        .delete(synchronize_session=False)
+    Item.query.filter(Item.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    # Identical uploads share a blob: keep it while an item still uses it
+    storage = get_storage()
+    for name in images:
+        if not reference_count(name):
+            storage.delete(name)
+            delete_variants(storage, name)
+    return moved, len(images)
+
+
+def init_app(app):
+    app.cli.add_command(archive_command)
+
+
+@click.command('archive-items')
+@click.option('--older-than', type=int, help='Days since an item was resolved (default: ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', type=int, help='Items per transaction (default: ARCHIVE_BATCH_SIZE).')
+@click.option('--dry-run', is_flag=True, help='Only count the items that would be archived.')
+@with_appcontext
+def archive_command(older_than, batch_size, dry_run):
+    """Move long-resolved items, their messages and images to the archive"""
+    from app.cache import bump_items_version
+
+    config = current_app.config
+    days = config['ARCHIVE_AFTER_DAYS'] if older_than is None else older_than
+    batch_size = batch_size or config['ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    if dry_run:
+        count = db.session.query(db.func.count(Item.id))\
+            .filter(Item.is_resolved == db.true(), Item.resolved_at < cutoff).scalar()
+        click.echo(f'{count} item(s) resolved more than {days} day(s) ago would be archived.')
+        return
+
+    started = time.perf_counter()
+    items = messages = images = 0
+    while True:
+        ids = candidates(cutoff, batch_size)
+        if not ids:
+            break
+        moved, copied = archive_items(ids)
+        items += len(ids)
+        messages += moved
+        images += copied
+
+    if items:
+        bump_items_version()
+        if db.engine.dialect.name == 'sqlite':
+            # Refresh the planner's statistics for the now smaller tables
+            db.session.execute(db.text('PRAGMA optimize'))
+    click.echo(f'Archived {items} item(s), {messages} message(s) and {images} image(s) '
+               f'in {time.perf_counter() - started:.1f}s.')
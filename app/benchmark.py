@@ -0,0 +1,374 @@
+"""
+Synthetic data and request benchmarks
+`flask seed-data` bulk-loads a reproducible campus-sized dataset: users,
+items across the category list and message threads, skewed so a few heavy
+users own many items and receive most messages (many of them unread).
+`flask benchmark` then drives the test client through the hot pages and
+reports p50/p95/p99 latency, SQL queries per request and throughput, and
+can save the numbers as a baseline or compare a run against one.
+"""
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta
+import click
+from flask import current_app, request_finished
+from flask.cli import with_appcontext
+from app import db
+from app.querycount import query_count
+
+# Every generated user has this password, so the benchmark can log in
+SEED_PASSWORD = 'benchmark'
+
+LOCATIONS = [
+    'Main Library', 'Student Union', 'Engineering Building', 'Science Hall',
+    'Gym', 'Cafeteria', 'Lecture Hall 3', 'Parking Lot B', 'Dormitory A',
+    'Bus Stop', 'Computer Lab', 'Art Studio', 'Football Field', 'Bookstore',
+]
+
+COLORS = ['black', 'blue', 'red', 'silver', 'green', 'white', 'brown', 'grey', 'pink']
+
+OBJECTS = {
+    'Electronics': ['phone', 'laptop', 'charger', 'earbuds', 'headphones', 'calculator', 'tablet'],
+    'Books': ['textbook', 'notebook', 'novel', 'lab manual', 'planner'],
+    'Clothing': ['jacket', 'hoodie', 'scarf', 'cap', 'gloves', 'sweater'],
+    'Accessories': ['watch', 'sunglasses', 'bracelet', 'ring', 'umbrella'],
+    'Keys': ['car keys', 'room key', 'key ring', 'bike lock key'],
+    'Bags': ['backpack', 'tote bag', 'gym bag', 'laptop sleeve', 'purse'],
+    'Documents': ['student ID', 'passport', 'wallet', 'library card', 'transcript'],
+    'Sports Equipment': ['water bottle', 'basketball', 'tennis racket', 'yoga mat'],
+    'Other': ['lunch box', 'guitar pick', 'thermos', 'pencil case'],
+}
+
+SCENARIOS = ('index', 'browse', 'browse_search', 'dashboard', 'inbox', 'post')
+
+
+def _skewed(rng, ids, skew, k):
+    """k ids drawn with Zipf-like weights: the first ids are picked far more often"""
+    weights = [1 / (rank + 1) ** skew for rank in range(len(ids))]
+    return rng.choices(ids, weights=weights, k=k)
+
+
+def _insert(model, rows):
+    """Insert rows in one statement; returns their ids in order"""
+    return db.session.scalars(
+        db.insert(model).returning(model.id, sort_by_parameter_order=True), rows
+    ).all()
+
+
+def seed(users, items, messages, seed_value=0, skew=1.1, unread_ratio=0.4, batch_size=2000, echo=None):
+    """
+    Add a synthetic dataset to the database and return the row counts.
+    The same seed_value gives the same data.
+    """
+    from app.models import User, Item, Message, Conversation, ConversationParticipant
+    from app.routes.items import CATEGORIES
+
+    echo = echo or (lambda message: None)
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    start = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    # Users (hashing once: every synthetic user has the same password)
+    password_hash = User()
+    password_hash.set_password(SEED_PASSWORD)
+    user_ids = []
+    for offset in range(0, users, batch_size):
+        user_ids += _insert(User, [{
+            'username': f'seed{start + n}',
+            'email': f'seed{start + n}@campus.example',
+            'password_hash': password_hash.password_hash,
+            'full_name': f'Seed User {start + n}',
+            'created_at': now - timedelta(days=rng.randint(30, 720)),
+        } for n in range(offset, min(users, offset + batch_size))])
+    db.session.commit()
+    echo(f'{len(user_ids)} users')
+
+    # Items, posted over the last six months mostly by the heavy users
+    item_rows = []
+    owners = _skewed(rng, user_ids, skew, items)
+    for owner in owners:
+        category = rng.choice(CATEGORIES)
+        thing = rng.choice(OBJECTS.get(category, OBJECTS['Other']))
+        color = rng.choice(COLORS)
+        location = rng.choice(LOCATIONS)
+        status = 'lost' if rng.random() < 0.55 else 'found'
+        created_at = now - timedelta(minutes=rng.randint(0, 180 * 24 * 60))
+        # Resolved items need resolved_at, or `flask archive-items` never selects them
+        resolved_at = None
+        if rng.random() < 0.25:
+            resolved_at = min(now, created_at + timedelta(minutes=rng.randint(60, 30 * 24 * 60)))
+        item_rows.append({
+            'title': f'{color.title()} {thing}',
+            'description': f'{color.title()} {thing} {status} near the {location.lower()}. '
+                           f'Please get in touch if it is yours.',
+            'category': category,
+            'status': status,
+            'location': location,
+            'date_lost_found': (created_at - timedelta(days=rng.randint(0, 3))).date(),
+            'is_resolved': resolved_at is not None,
+            'resolved_at': resolved_at,
+            'created_at': created_at,
+            'updated_at': resolved_at or created_at,
+            'user_id': owner,
+        })
+    item_rows.sort(key=lambda row: row['created_at'])
+    item_ids = []
+    for offset in range(0, len(item_rows), batch_size):
+        item_ids += _insert(Item, item_rows[offset:offset + batch_size])
+        db.session.commit()
+    echo(f'{len(item_ids)} items')
+
+    # Message threads about items, between the owner and someone else
+    made = conversations = 0
+    targets = _skewed(rng, list(range(len(item_ids))), skew / 2, max(1, messages // 3))
+    while made < messages:
+        batch = []
+        for index in targets:
+            if made >= messages or len(batch) >= batch_size // 4:
+                break
+            owner = item_rows[index]['user_id']
+            other = _skewed(rng, user_ids, skew, 1)[0]
+            if other == owner:
+                continue
+            length = min(messages - made, 1 + int(rng.expovariate(0.6)))
+            at = item_rows[index]['created_at']
+            thread = []
+            for n in range(length):
+                at = min(now, at + timedelta(minutes=rng.randint(5, 3 * 24 * 60)))
+                sender, receiver = (other, owner) if n % 2 == 0 else (owner, other)
+                thread.append({
+                    'subject': ('Re: ' if n else '') + f'About your {item_rows[index]["title"].lower()}',
+                    'body': rng.choice([
+                        'Hi, I think this might be mine. Where can I pick it up?',
+                        'I saw your post - does it have a name written on it?',
+                        'Thanks! I can meet at the front desk tomorrow afternoon.',
+                        'Is it still available? I lost one just like it last week.',
+                    ]),
+                    'is_read': rng.random() >= unread_ratio,
+                    'created_at': at,
+                    'sender_id': sender,
+                    'receiver_id': receiver,
+                    'item_id': item_ids[index],
+                })
+            batch.append((item_ids[index], owner, other, thread))
+            made += length
+        targets = _skewed(rng, list(range(len(item_ids))), skew / 2, max(1, messages // 3))
+        if not batch:
+            continue
+
+        conversation_ids = _insert(Conversation, [{
+            'subject': thread[0]['subject'], 'item_id': item_id, 'created_at': thread[0]['created_at'],
+        } for item_id, _, _, thread in batch])
+        message_rows = []
+        participant_rows = []
+        for conversation_id, (item_id, owner, other, thread) in zip(conversation_ids, batch):
+            for row in thread:
+                row['conversation_id'] = conversation_id
+            message_rows += thread
+            participant_rows += [{'conversation_id': conversation_id, 'user_id': user_id,
+                                  'last_message_at': thread[-1]['created_at']} for user_id in (owner, other)]
+        _insert(Message, message_rows)
+        db.session.execute(db.insert(ConversationParticipant), participant_rows)
+        conversations += len(batch)
+        db.session.commit()
+    echo(f'{made} messages in {conversations} conversations')
+
+    # Point conversations at their newest message; recount unread messages
+    from app.cache import bump_items_version
+    from app.unread import rebuild_counts
+    newest = db.select(db.func.max(Message.id)).where(Message.conversation_id == Conversation.id)\
+        .scalar_subquery()
+    db.session.query(Conversation).filter(Conversation.last_message_id.is_(None))\
+        .update({Conversation.last_message_id: newest}, synchronize_session=False)
+    db.session.commit()
+    rebuild_counts()
+    bump_items_version()
+    return {'users': len(user_ids), 'items': len(item_ids), 'messages': made, 'conversations': conversations}
+
+
+@click.command('seed-data')
+@click.option('--users', default=2000, help='Users to create.')
+@click.option('--items', default=20000, help='Items to create.')
+@click.option('--messages', default=50000, help='Messages to create.')
+@click.option('--seed', 'seed_value', default=0, help='Random seed; the same seed gives the same data.')
+@click.option('--skew', default=1.1, help='Zipf exponent of activity per user (0 = uniform).')
+@click.option('--unread-ratio', default=0.4, help='Share of messages left unread.')
+@with_appcontext
+def seed_command(users, items, messages, seed_value, skew, unread_ratio):
+    """Bulk-load a synthetic dataset for benchmarks"""
+    started = time.perf_counter()
+    counts = seed(users, items, messages, seed_value, skew, unread_ratio, echo=click.echo)
+    click.echo(f'Seeded {counts["users"]} users, {counts["items"]} items and '
+               f'{counts["messages"]} messages in {time.perf_counter() - started:.1f}s '
+               f'(password for every user: {SEED_PASSWORD!r}).')
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _scenarios(rng, search_words):
+    """Scenario name -> function(client) making one request"""
+    from app.routes.items import CATEGORIES
+
+    def post(client):
+        category = rng.choice(CATEGORIES)
+        thing = rng.choice(OBJECTS.get(category, OBJECTS['Other']))
+        return client.post('/items/post', data={
+            'title': f'Benchmark {thing}',
+            'description': f'A {thing} posted by the benchmark.',
+            'category': category,
+            'status': rng.choice(['lost', 'found']),
+            'location': rng.choice(LOCATIONS),
+            'date_lost_found': datetime.utcnow().strftime('%Y-%m-%d'),
+        })
+
+    return {
+        'index': lambda client: client.get('/'),
+        'browse': lambda client: client.get('/items/browse'),
+        'browse_search': lambda client: client.get('/items/browse', query_string={'q': rng.choice(search_words)}),
+        'dashboard': lambda client: client.get('/items/dashboard'),
+        'inbox': lambda client: client.get('/messages/inbox'),
+        'post': post,
+    }
+
+
+def run(app, username, password, requests, warmup=10, scenarios=SCENARIOS, seed_value=0):
+    """
+    Time each scenario as username and return
+    {scenario: {'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'queries', 'rps', 'errors'}}.
+    Requests run one after another, so rps is single-client throughput.
+    """
+    rng = random.Random(seed_value)
+    words = sorted({word for things in OBJECTS.values() for thing in things for word in thing.split()})
+    makers = _scenarios(rng, words)
+
+    client = app.test_client()
+
+    def send(make):
+        # A fresh app context per request, as under a real server: inside the
+        # CLI's context every request would share one g (and one query count)
+        with app.app_context():
+            return make(client)
+
+    response = send(lambda client: client.post('/auth/login', data={'username': username, 'password': password}))
+    if response.status_code != 302:
+        raise click.ClickException(f'Could not log in as {username!r}')
+
+    counts = []
+
+    def on_finished(sender, response, **extra):
+        counts.append(query_count())
+
+    results = {}
+    request_finished.connect(on_finished, app)
+    try:
+        for name in scenarios:
+            make = makers[name]
+            for _ in range(warmup):
+                send(make)
+            del counts[:]
+            latencies = []
+            errors = 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                began = time.perf_counter()
+                response = send(make)
+                latencies.append((time.perf_counter() - began) * 1000)
+                errors += response.status_code >= 400
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            results[name] = {
+                'p50_ms': round(_percentile(latencies, 50), 3),
+                'p95_ms': round(_percentile(latencies, 95), 3),
+                'p99_ms': round(_percentile(latencies, 99), 3),
+                'mean_ms': round(sum(latencies) / len(latencies), 3),
+                'queries': round(sum(counts) / max(1, len(counts)), 2),
+                'rps': round(requests / elapsed, 1),
+                'errors': errors,
+            }
+    finally:
+        request_finished.disconnect(on_finished, app)
+    return results
+
+
+def compare(results, baseline, tolerance, floor_ms=1.0):
+    """
+    Regressions of results against a baseline: p95 slower by more than
+    tolerance (and by more than floor_ms, to ignore timer noise), or more
+    queries per request. Returns a list of messages.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        limit = before['p95_ms'] * (1 + tolerance)
+        if result['p95_ms'] > limit and result['p95_ms'] - before['p95_ms'] > floor_ms:
+            regressions.append(f'{name}: p95 {result["p95_ms"]:.1f} ms, baseline {before["p95_ms"]:.1f} ms')
+        if result['queries'] > before['queries']:
+            regressions.append(f'{name}: {result["queries"]} queries per request, baseline {before["queries"]}')
+    return regressions
+
+
+def _default_user():
+    """Username of the user with the most items (the heaviest seeded user)"""
+    from app.models import Item, User
+
+    return db.session.query(User.username).join(Item, Item.user_id == User.id)\
+        .group_by(User.id).order_by(db.func.count(Item.id).desc(), User.id).limit(1).scalar()
+
+
+@click.command('benchmark')
+@click.option('--requests', 'count', default=200, help='Timed requests per scenario.')
+@click.option('--warmup', default=10, help='Untimed requests per scenario first.')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help='Scenario to run (repeatable; default all).')
+@click.option('--user', 'username', help='User to log in as (default: the one with most items).')
+@click.option('--password', default=SEED_PASSWORD, show_default=True)
+@click.option('--baseline', type=click.Path(dir_okay=False), help='Compare with this baseline file.')
+@click.option('--save-baseline', type=click.Path(dir_okay=False), help='Write the results to this file.')
+@click.option('--tolerance', default=0.2, help='Allowed p95 slowdown against the baseline (0.2 = 20%).')
+@with_appcontext
+def benchmark_command(count, warmup, scenarios, username, password, baseline, save_baseline, tolerance):
+    """Time the hot pages and compare against a baseline"""
+    app = current_app._get_current_object()
+    username = username or _default_user()
+    if not username:
+        raise click.ClickException('No users with items; run "flask seed-data" first.')
+    results = run(app, username, password, count, warmup, scenarios or SCENARIOS)
+
+    previous = {}
+    if baseline:
+        with open(baseline) as fp:
+            previous = json.load(fp)['results']
+
+    click.echo(f'{"scenario":<14}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}{"req/s":>9}{"errors":>8}'
+               + ('   p95 vs baseline' if previous else ''))
+    for name, result in results.items():
+        line = (f'{name:<14}{result["p50_ms"]:>9.1f}{result["p95_ms"]:>9.1f}{result["p99_ms"]:>9.1f}'
+                f'{result["queries"]:>9}{result["rps"]:>9.1f}{result["errors"]:>8}')
+        if name in previous:
+            change = (result['p95_ms'] / previous[name]['p95_ms'] - 1) * 100
+            line += f'   {change:+.0f}%'
+        click.echo(line)
+
+    if save_baseline:
+        with open(save_baseline, 'w') as fp:
+            json.dump({'created_at': datetime.utcnow().isoformat(), 'user': username,
+                       'requests': count, 'results': results}, fp, indent=2)
+        click.echo(f'Baseline written to {save_baseline}')
+
+    regressions = compare(results, previous, tolerance)
+    if regressions:
+        for regression in regressions:
+            click.echo(f'REGRESSION {regression}', err=True)
+        raise click.ClickException(f'{len(regressions)} regression(s) against {baseline}')
+
+
+def init_app(app):
+    app.cli.add_command(seed_command)
+    app.cli.add_command(benchmark_command)
@@ -0,0 +1,241 @@
+"""
+Bulk import and export
+`flask items-import` loads items (and their images) from a CSV or JSONL file
+in batches, committing each batch so memory stays flat however large the
+file is. `flask export` streams items or messages out to CSV or JSONL with
+a server-side cursor instead of loading every row first.
+"""
+import csv
+import json
+import os
+import time
+from datetime import date, datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.datastructures import FileStorage
+from app import db, jobs
+
+REQUIRED_FIELDS = ('title', 'description', 'category', 'status', 'date_lost_found')
+
+
+def _detect_format(path, fmt):
+    """'csv' or 'jsonl', from --format or the file extension"""
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def _read_rows(fp, fmt):
+    """
+    Yield (line number, row) from a CSV or JSONL file, one at a time. A CSV
+    row is a dict, a JSONL row the raw line: _item_values parses it, so a
+    malformed line is skipped like any other invalid row.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(fp)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(fp, start=1):
+            if line.strip():
+                yield number, line
+
+
+def _parse_row(row):
+    """The row as a dict; raises ValueError for a line that is not a JSON object"""
+    if isinstance(row, str):
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError('not a JSON object')
+    return row
+
+
+def _text(row, field):
+    """A field's stripped text ('' if absent); raises ValueError if it is not text"""
+    value = row.get(field)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be text, not {type(value).__name__}')
+    return value.strip()
+
+
+def _save_image(path, images_dir):
+    """Store an image file the same way as a form upload; returns its blob name"""
+    if not os.path.isabs(path):
+        path = os.path.join(images_dir or '.', path)
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension not in current_app.config['ALLOWED_EXTENSIONS']:
+        raise ValueError(f'unsupported image type: {path}')
+
+    from app.storage import save_upload
+    with open(path, 'rb') as stream:
+        return save_upload(FileStorage(stream=stream, filename=os.path.basename(path)))
+
+
+def _item_values(row, owners, default_owner, images_dir):
+    """Column values for one imported row; raises ValueError if it is invalid"""
+    from app.models import User
+
+    row = _parse_row(row)
+    missing = [field for field in REQUIRED_FIELDS if not _text(row, field)]
+    if missing:
+        raise ValueError('missing ' + ', '.join(missing))
+    status = _text(row, 'status').lower()
+    if status not in ('lost', 'found'):
+        raise ValueError(f'status must be lost or found, not {status!r}')
+
+    owner = _text(row, 'owner') or default_owner
+    if owner not in owners:
+        owners[owner] = db.session.query(User.id).filter_by(username=owner).scalar()
+    if owners[owner] is None:
+        raise ValueError(f'unknown owner {owner!r}')
+
+    date_lost_found = datetime.strptime(_text(row, 'date_lost_found')[:10], '%Y-%m-%d').date()
+
+    # Resolved rows need resolved_at, or `flask archive-items` never moves them
+    is_resolved = str(row.get('is_resolved') or '').strip().lower() in ('1', 'true', 'yes')
+    resolved_at = None
+    if is_resolved:
+        resolved_at = _text(row, 'resolved_at')
+        resolved_at = datetime.fromisoformat(resolved_at) if resolved_at else datetime.utcnow()
+
+    image = _text(row, 'image')
+    stored = _text(row, 'image_filename')
+    if not image and stored:
+        # Re-importing an export: the blob is already in storage
+        from app.storage import get_storage
+        if not get_storage().exists(stored):
+            raise ValueError(f'stored image {stored!r} not found')
+
+    # Saved last, so a row rejected above never leaves an orphaned blob
+    image_filename = _save_image(image, images_dir) if image else stored or None
+
+    return {
+        'title': _text(row, 'title'),
+        'description': _text(row, 'description'),
+        'category': _text(row, 'category'),
+        'status': status,
+        'location': _text(row, 'location') or None,
+        'date_lost_found': date_lost_found,
+        'is_resolved': is_resolved,
+        'resolved_at': resolved_at,
+        'image_filename': image_filename,
+        'user_id': owners[owner],
+    }
+
+
+def _insert_batch(batch):
+    """Insert one batch of items in a single statement and commit it"""
+    from app.models import Item
+
+    ids = db.session.scalars(
+        db.insert(Item).returning(Item.id, sort_by_parameter_order=True), batch
+    ).all()
+    db.session.commit()
+    for item_id, values in zip(ids, batch):
+        if values['image_filename']:
+            jobs.enqueue('process_item_image', item_id, values['image_filename'])
+
+
+@click.command('items-import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--owner', required=True, help='Username that owns rows without an "owner" column.')
+@click.option('--images-dir', type=click.Path(file_okay=False), help='Folder that "image" paths are relative to.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=500, help='Rows per INSERT and commit.')
+@with_appcontext
+def import_command(path, owner, images_dir, fmt, batch_size):
+    """Import items from a CSV or JSONL file"""
+    from app.cache import bump_items_version
+
+    owners = {}
+    batch = []
+    imported = skipped = 0
+    start = time.perf_counter()
+
+    with open(path, newline='', encoding='utf-8') as fp:
+        for line, row in _read_rows(fp, _detect_format(path, fmt)):
+            try:
+                batch.append(_item_values(row, owners, owner, images_dir))
+            except (ValueError, OSError) as exc:
+                click.echo(f'line {line}: skipped ({exc})', err=True)
+                skipped += 1
+                continue
+            if len(batch) >= batch_size:
+                _insert_batch(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            _insert_batch(batch)
+            imported += len(batch)
+
+    # Bulk inserts bypass the ORM events that normally invalidate cached pages
+    bump_items_version()
+    if imported:
+        jobs.enqueue('match_all')
+    elapsed = time.perf_counter() - start
+    click.echo(f'Imported {imported} item(s), skipped {skipped}, '
+               f'in {elapsed:.2f}s ({imported / max(elapsed, 1e-9):.0f} rows/sec)', err=True)
+
+
+def _export_query(kind):
+    """SELECT of every exported column, with usernames instead of user ids"""
+    from app.models import Item, Message, User
+
+    if kind == 'items':
+        columns = [column for column in Item.__table__.c if column.name != 'image_placeholder']
+        return db.select(*columns, User.username.label('owner')).join(
+            User, User.id == Item.user_id).order_by(Item.id)
+
+    sender = db.aliased(User)
+    receiver = db.aliased(User)
+    return db.select(*Message.__table__.c,
+                     sender.username.label('sender'),
+                     receiver.username.label('receiver')).join(
+        sender, sender.id == Message.sender_id).join(
+        receiver, receiver.id == Message.receiver_id).order_by(Message.id)
+
+
+def _plain(value):
+    """JSON/CSV-friendly form of a column value"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+@click.command('export')
+@click.argument('kind', type=click.Choice(['items', 'messages']))
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-',
+              help='File to write (default: standard output).')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default='jsonl')
+@click.option('--chunk-size', default=1000, help='Rows fetched from the database at a time.')
+@with_appcontext
+def export_command(kind, output, fmt, chunk_size):
+    """Stream items or messages to JSONL or CSV"""
+    start = time.perf_counter()
+    count = 0
+
+    result = db.session.execute(_export_query(kind).execution_options(yield_per=chunk_size))
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(result.keys())
+    keys = list(result.keys())
+
+    for row in result:
+        if writer:
+            writer.writerow([_plain(value) for value in row])
+        else:
+            output.write(json.dumps(dict(zip(keys, map(_plain, row)))) + '\n')
+        count += 1
+
+    elapsed = time.perf_counter() - start
+    click.echo(f'Exported {count} {kind} in {elapsed:.2f}s '
+               f'({count / max(elapsed, 1e-9):.0f} rows/sec)', err=True)
+
+
+def init_app(app):
+    app.cli.add_command(import_command)
+    app.cli.add_command(export_command)
@@ -0,0 +1,227 @@
+"""
+Page caching for anonymous visitors
+Rendered pages are kept in an in-process LRU (optionally backed by a shared
+Redis cache) and keyed by endpoint, normalized query arguments and a content
+version. Any committed change to an Item bumps the version, so stale pages
+are never served again - they simply stop being looked up and age out.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Namespace whose version changes whenever an Item changes
+ITEMS = 'items'
+
+
+class LRUCache:
+    """Thread-safe in-memory cache that evicts the least recently used entry"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Cache shared by every worker, stored in Redis"""
+
+    def __init__(self, url, prefix='lnf:'):
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError('CACHE_BACKEND = "redis" requires redis (pip install redis)') from exc
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class PageCache:
+    """Local LRU in front of an optional shared backend"""
+
+    def __init__(self, max_entries=512, default_ttl=60, shared=None):
+        self.local = LRUCache(max_entries)
+        self.shared = shared
+        self.default_ttl = default_ttl
+        # Versions live outside the LRU so they can never be evicted
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, namespace):
+        """Current content version of a namespace"""
+        key = f'version:{namespace}'
+        if self.shared is not None:
+            return int(self.shared.get(key) or 0)
+        return self._versions.get(key, 0)
+
+    def bump(self, namespace):
+        """Invalidate every cached page that depends on namespace"""
+        key = f'version:{namespace}'
+        if self.shared is not None:
+            self.shared.incr(key)
+        else:
+            with self._lock:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, self.default_ttl)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.default_ttl
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+
+def get_cache():
+    """Page cache of the current app"""
+    return current_app.extensions['page_cache']
+
+
+def normalized_args():
+    """Query arguments with blanks dropped and keys in a fixed order"""
+    pairs = []
+    for key in sorted(request.args):
+        for value in request.args.getlist(key):
+            value = value.strip()
+            if value:
+                pairs.append((key, value))
+    return urlencode(pairs)
+
+
+def page_key(namespace):
+    """Cache key for the current request"""
+    version = get_cache().version(namespace)
+    raw = f'{request.endpoint}?{normalized_args()}'
+    return f'page:{namespace}:{version}:' + hashlib.sha1(raw.encode()).hexdigest()
+
+
+def listing_version(namespace=ITEMS):
+    """
+    Version of the current listing page, for HTTP validators.
+    Without a shared backend other workers never see this worker's version
+    bumps, so the version also rolls over every CACHE_DEFAULT_TTL seconds.
+    """
+    cache = get_cache()
+    version = str(cache.version(namespace))
+    if cache.shared is None and cache.default_ttl:
+        version += f'.{int(time.time() // cache.default_ttl)}'
+    return f'{version}?{normalized_args()}'
+
+
+def cached_page(namespace=ITEMS, ttl=None):
+    """
+    Cache a view's rendered page for anonymous visitors.
+    Logged-in users, pending flash messages and non-200 responses always
+    go through the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not current_app.config.get('CACHE_ENABLED')
+                    or current_user.is_authenticated
+                    or '_flashes' in session):
+                return view(*args, **kwargs)
+
+            cache = get_cache()
+            key = page_key(namespace)
+            body = cache.get(key)
+            if body is not None:
+                response = make_response(body)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not session.modified:
+                cache.set(key, response.get_data(), ttl)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def bump_items_version():
+    """Invalidate cached pages that list items"""
+    get_cache().bump(ITEMS)
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_item_changes(session, flush_context, instances):
+    """Remember whether this transaction adds, changes or deletes an Item"""
+    from app.models import Item
+    changed = session.new | session.dirty | session.deleted
+    if any(isinstance(obj, Item) for obj in changed):
+        session.info['items_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(session):
+    if session.info.pop('items_changed', False):
+        bump_items_version()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('items_changed', None)
+
+
+def init_app(app):
+    """Create the page cache for the app"""
+    shared = None
+    if app.config.get('CACHE_BACKEND') == 'redis':
+        shared = RedisCache(app.config['CACHE_REDIS_URL'])
+    app.extensions['page_cache'] = PageCache(
+        max_entries=app.config.get('CACHE_MAX_ENTRIES', 512),
+        default_ttl=app.config.get('CACHE_DEFAULT_TTL', 60),
+        shared=shared,
+    )
@@ -0,0 +1,77 @@
+"""
+HTTP conditional requests
+Views decorated with @conditional compute a cheap validator (an ETag and
+optionally a Last-Modified time) before doing any real work. If the client
+or a proxy already has that version of the page, a 304 Not Modified is
+returned without rendering the template.
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+
+def _viewer_tag():
+    """
+    Part of the ETag that depends on who is looking: logged-in pages show the
+    username and unread count in the navigation bar
+    """
+    if not current_user.is_authenticated:
+        return 'anon'
+    from app.unread import unread_count_for
+    return f'u{current_user.get_id()}-{unread_count_for(current_user)}'
+
+
+def _apply_headers(response, etag, last_modified):
+    """Set validators and caching headers on a full or 304 response"""
+    response.set_etag(etag, weak=True)
+    response.vary.add('Cookie')
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+        response.cache_control.must_revalidate = True
+        if last_modified is not None:
+            response.last_modified = last_modified
+    return response
+
+
+def conditional(validator):
+    """
+    Answer conditional GETs for a view.
+    validator(**view_kwargs) returns (version, last_modified), where version
+    is any string that changes whenever the page content changes and
+    last_modified is a naive UTC datetime or None.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pages showing a one-off flash message must not be revalidated
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            version, last_modified = validator(**kwargs)
+            raw = f'{request.endpoint}|{version}|{_viewer_tag()}'
+            etag = hashlib.sha1(raw.encode()).hexdigest()[:20]
+            if last_modified is not None:
+                last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+            if current_user.is_authenticated:
+                # Last-Modified cannot see changes to the navigation bar
+                last_modified = None
+
+            # Check the validators before rendering anything
+            probe = current_app.response_class()
+            _apply_headers(probe, etag, last_modified)
+            probe.make_conditional(request)
+            if probe.status_code == 304:
+                return probe
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            return _apply_headers(response, etag, last_modified)
+        return wrapper
+    return decorator
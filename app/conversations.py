@@ -0,0 +1,75 @@
+"""
+Conversations
+Every message belongs to a conversation between its sender and receiver.
+These helpers keep each conversation's last message and its participants'
+activity times up to date, so listing conversations and reading a thread
+each stay a single indexed query (see app/queries.py). The receiver of a
+new message is notified live once it commits (see app/events.py).
+"""
+from flask import url_for
+from app import db, unread, events
+from app.models import Conversation, ConversationParticipant, Message
+
+
+def start(sender_id, receiver_id, subject, item_id=None):
+    """Create a conversation between two users"""
+    conversation = Conversation(subject=subject, item_id=item_id)
+    conversation.participants = [
+        ConversationParticipant(user_id=sender_id),
+        ConversationParticipant(user_id=receiver_id),
+    ]
+    db.session.add(conversation)
+    return conversation
+
+
+def add_message(conversation, message):
+    """Add a message to a conversation and make it the latest one"""
+    message.conversation = conversation
+    db.session.add(message)
+    db.session.flush()
+
+    conversation.last_message_id = message.id
+    ConversationParticipant.query.filter_by(conversation_id=conversation.id)\
+        .update({ConversationParticipant.last_message_at: message.created_at},
+                synchronize_session=False)
+    unread.adjust(message.receiver_id, 1)
+    events.publish_after_commit(message.receiver_id, 'message', {
+        'id': message.id,
+        'subject': message.subject,
+        'url': url_for('messages.thread', conversation_id=conversation.id),
+    })
+
+
+def other_participant_id(conversation_id, user_id):
+    """The user on the other side of a conversation, or None if user_id is not in it"""
+    ids = [row.user_id for row in db.session.query(ConversationParticipant.user_id)
+           .filter_by(conversation_id=conversation_id)]
+    if user_id not in ids:
+        return None
+    others = [other for other in ids if other != user_id]
+    return others[0] if others else None
+
+
+def mark_read(conversation_id, user_id):
+    """Mark every message the user received in a conversation as read"""
+    count = Message.query.filter_by(conversation_id=conversation_id, receiver_id=user_id, is_read=False)\
+        .update({Message.is_read: True}, synchronize_session=False)
+    if count:
+        unread.adjust(user_id, -count)
+    return count
+
+
+def refresh(conversation_id):
+    """Point a conversation at its newest message after one was deleted; drop it when empty"""
+    conversation = db.session.get(Conversation, conversation_id)
+    if conversation is None:
+        return
+    last = Message.query.filter_by(conversation_id=conversation_id)\
+        .order_by(Message.created_at.desc(), Message.id.desc()).first()
+    if last is None:
+        db.session.delete(conversation)
+        return
+    conversation.last_message_id = last.id
+    ConversationParticipant.query.filter_by(conversation_id=conversation_id)\
+        .update({ConversationParticipant.last_message_at: last.created_at},
+                synchronize_session=False)
@@ -0,0 +1,108 @@
+"""
+Database engine tuning
+Applies SQLITE_PRAGMAS to every new SQLite connection (WAL journaling,
+relaxed fsync, memory-mapped I/O, a bigger page cache and a busy timeout)
+so concurrent writers queue up instead of failing with "database is
+locked". Pool settings for server databases come from
+SQLALCHEMY_ENGINE_OPTIONS.
+"""
+import os
+import tempfile
+import threading
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from app import db
+
+# SQLite's own defaults, used as the baseline by the benchmark
+SQLITE_DEFAULT_PRAGMAS = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'busy_timeout': 0,
+}
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """Run the given PRAGMA statements on each new connection of engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def init_app(app):
+    """Tune the app's engine and register the benchmark command"""
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, app.config.get('SQLITE_PRAGMAS'))
+    app.cli.add_command(benchmark_command)
+
+
+def _run_writers(engine, writers, writes):
+    """Commit small inserts from several threads; return (seconds, commits, errors)"""
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS bench_writes '
+                          '(id INTEGER PRIMARY KEY, writer INTEGER, payload TEXT)'))
+
+    counts = {'commits': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def writer(n):
+        for i in range(writes):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text('INSERT INTO bench_writes (writer, payload) VALUES (:w, :p)'),
+                                 {'w': n, 'p': 'x' * 200})
+                key = 'commits'
+            except OperationalError:
+                key = 'errors'
+            with lock:
+                counts[key] += 1
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, counts['commits'], counts['errors']
+
+
+def _report(label, elapsed, commits, errors):
+    click.echo(f'{label:<10} {commits / elapsed:9.1f} commits/s   '
+               f'{commits:6d} ok   {errors:6d} failed   {elapsed:6.2f}s')
+
+
+@click.command('db-benchmark')
+@click.option('--writers', default=8, help='Concurrent writer threads.')
+@click.option('--writes', default=200, help='Commits per writer.')
+@with_appcontext
+def benchmark_command(writers, writes):
+    """Compare concurrent write throughput with default and tuned settings"""
+    from flask import current_app
+
+    if db.engine.dialect.name != 'sqlite':
+        # Server databases: measure the configured engine with a scratch table
+        engine = create_engine(db.engine.url, **current_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        try:
+            _report('configured', *_run_writers(engine, writers, writes))
+        finally:
+            with engine.begin() as conn:
+                conn.execute(text('DROP TABLE bench_writes'))
+            engine.dispose()
+        return
+
+    # SQLite: run the same load against scratch files with each set of pragmas
+    tuned = current_app.config.get('SQLITE_PRAGMAS') or {}
+    for label, pragmas in (('default', SQLITE_DEFAULT_PRAGMAS), ('tuned', tuned)):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine('sqlite:///' + os.path.join(tmp, 'bench.db'))
+            apply_sqlite_pragmas(engine, pragmas)
+            _report(label, *_run_writers(engine, writers, writes))
+            engine.dispose()
@@ -0,0 +1,241 @@
+"""
+Live notifications over Server-Sent Events
+Each logged-in page keeps one EventSource open on /messages/events. When a
+transaction that changes someone's unread count commits, that user gets an
+'unread' event with the new count, and a new message also sends a
+'message' event, so the navigation badge updates without reloading.
+
+Streams subscribe to a Hub in their own worker process. Events go through
+a broker chosen by EVENTS_BACKEND: 'memory' delivers to this process only,
+'redis' relays through a Redis pub/sub channel to every worker, published
+from a background thread so a slow or unreachable Redis never holds up the
+request that committed. The hub
+only uses queue and threading, so under gevent (monkey-patched) each open
+stream costs a greenlet rather than a thread.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+
+class Hub:
+    """Fan-out of events to the open streams of this process, per user"""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)  # user_id -> set of queues
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """A new queue that receives the user's events"""
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[user_id].add(q)
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def deliver(self, user_id, name, data):
+        """Put an event on every queue of the user; a stream that fell behind misses it"""
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, ()))
+        for q in queues:
+            try:
+                q.put_nowait((name, data))
+            except queue.Full:
+                pass
+
+
+class LocalBroker:
+    """Delivers events to streams in this process only"""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def wants(self, user_id):
+        return self.hub.has_subscribers(user_id)
+
+    def publish(self, user_id, name, data):
+        self.hub.deliver(user_id, name, data)
+
+    def start(self):
+        pass
+
+
+class RedisBroker:
+    """Relays events between worker processes through a Redis pub/sub channel"""
+
+    def __init__(self, hub, url, channel='lnf:events', timeout=1.0, outbox_size=1000):
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError('EVENTS_BACKEND = "redis" requires redis (pip install redis)') from exc
+        self.hub = hub
+        self.client = redis.Redis.from_url(url)
+        # Publishing has its own connection with short timeouts, so a stalled
+        # Redis drops notifications instead of queueing them up forever
+        self._publisher = redis.Redis.from_url(url, socket_timeout=timeout,
+                                               socket_connect_timeout=timeout)
+        self.channel = channel
+        self._outbox = queue.Queue(maxsize=outbox_size)
+        self._listener = None
+        self._sender = None
+        self._lock = threading.Lock()
+
+    def wants(self, user_id):
+        # Another worker may hold the user's stream
+        return True
+
+    def publish(self, user_id, name, data):
+        """Hand the event to the sender thread; never waits on Redis"""
+        with self._lock:
+            if self._sender is None or not self._sender.is_alive():
+                self._sender = threading.Thread(target=self._send, name='events-sender', daemon=True)
+                self._sender.start()
+        try:
+            self._outbox.put_nowait(json.dumps([user_id, name, data]))
+        except queue.Full:
+            logger.warning('Events outbox is full; dropped a %s event', name)
+
+    def _send(self):
+        while True:
+            payload = self._outbox.get()
+            try:
+                self._publisher.publish(self.channel, payload)
+            except Exception:
+                logger.exception('Could not publish an event')
+
+    def start(self):
+        """Listen on the channel; started by the first stream of the process"""
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='events-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    user_id, name, data = json.loads(message['data'])
+                    self.hub.deliver(user_id, name, data)
+            except Exception:
+                logger.exception('Lost the events channel; reconnecting')
+                time.sleep(1)
+
+
+def get_broker():
+    return current_app.extensions.get('events')
+
+
+def publish_after_commit(user_id, name, data):
+    """Send an event to a user's streams once the current transaction commits"""
+    from app import db
+    broker = get_broker()
+    if broker is not None and broker.wants(user_id):
+        db.session.info.setdefault('pending_events', []).append((user_id, name, data))
+
+
+@event.listens_for(Session, 'before_commit')
+def _unread_events(session):
+    """Read the new counts of users whose unread counter changed, still inside the transaction"""
+    dirty = session.info.get('unread_dirty')
+    if not dirty or not has_app_context():
+        return
+    broker = get_broker()
+    if broker is None:
+        return
+    user_ids = [user_id for user_id in dirty if broker.wants(user_id)]
+    if not user_ids:
+        return
+    from app.models import User
+    rows = session.query(User.id, User.unread_count).filter(User.id.in_(user_ids))
+    pending = session.info.setdefault('pending_events', [])
+    pending.extend((user_id, 'unread', {'count': count or 0}) for user_id, count in rows)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish(session):
+    pending = session.info.pop('pending_events', None)
+    if not pending:
+        return
+    broker = get_broker()
+    for user_id, name, data in pending:
+        try:
+            broker.publish(user_id, name, data)
+        except Exception:
+            # The change is committed; a missed notification only delays the badge
+            logger.exception('Could not publish %s event', name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_events(session):
+    session.info.pop('pending_events', None)
+
+
+def _format(name, data):
+    return f'event: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def stream(user_id, unread_count):
+    """
+    Body of an event stream: the current count, then the user's events and a
+    comment every EVENTS_HEARTBEAT seconds. It ends after EVENTS_MAX_AGE so
+    the browser reconnects (and a sync worker is not held forever).
+    """
+    config = current_app.config
+    broker = get_broker()
+    heartbeat, max_age = config['EVENTS_HEARTBEAT'], config['EVENTS_MAX_AGE']
+    retry_ms = config['EVENTS_RETRY_MS']
+    broker.start()
+
+    def generate():
+        q = broker.hub.subscribe(user_id)
+        try:
+            yield f'retry: {retry_ms}\n\n'
+            yield _format('unread', {'count': unread_count})
+            deadline = time.monotonic() + max_age
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    name, data = q.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield _format(name, data)
+        finally:
+            broker.hub.unsubscribe(user_id, q)
+
+    return generate()
+
+
+def init_app(app):
+    """Create the events hub and broker for the app"""
+    if not app.config.get('EVENTS_ENABLED'):
+        return
+    hub = Hub(app.config.get('EVENTS_QUEUE_SIZE', 100))
+    if app.config.get('EVENTS_BACKEND') == 'redis':
+        app.extensions['events'] = RedisBroker(hub, app.config['EVENTS_REDIS_URL'],
+                                               timeout=app.config.get('EVENTS_REDIS_TIMEOUT', 1.0))
+    else:
+        app.extensions['events'] = LocalBroker(hub)
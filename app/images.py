@@ -0,0 +1,114 @@
+"""
+Image processing for item uploads
+Writes resized copies of each uploaded image in modern formats, plus a tiny
+blurred placeholder, so pages can request the size they actually render
+instead of the full-size original
+"""
+import base64
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Variant name -> width in pixels (about 2x the largest size it is shown at)
+VARIANT_WIDTHS = {
+    'thumb': 128,   # dashboard rows, message previews
+    'card': 480,    # browse and homepage cards
+    'large': 1200,  # item detail page
+}
+
+# Preferred formats, best compression first
+FORMAT_QUALITY = {
+    'avif': 50,
+    'webp': 80,
+}
+
+MIME_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+
+PLACEHOLDER_WIDTH = 16
+
+
+def _pillow():
+    """
+    Pillow's Image module, imported on first use so it stays out of app
+    start-up. None when Pillow is not installed (only originals are served).
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def available_formats():
+    """Output formats supported by the installed Pillow build"""
+    if _pillow() is None:
+        return []
+    from PIL import features
+    return [fmt for fmt in FORMAT_QUALITY if features.check(fmt)]
+
+
+def variant_filename(filename, size, fmt):
+    """Name of a resized copy, e.g. photo.jpg -> photo.card.webp"""
+    stem = filename.rsplit('.', 1)[0]
+    return f'{stem}.{size}.{fmt}'
+
+
+def variant_filenames(filename, formats):
+    """Every variant filename written for an upload"""
+    return [variant_filename(filename, size, fmt)
+            for size in VARIANT_WIDTHS for fmt in formats]
+
+
+def _resized(image, width):
+    """Copy of image scaled down to width (never scaled up)"""
+    if image.width <= width:
+        return image.copy()
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), _pillow().LANCZOS)
+
+
+def process_image(storage, filename):
+    """
+    Write size variants and a placeholder for an uploaded image to storage.
+    Returns (formats, placeholder): the formats written, as a comma-separated
+    string, and a data: URI for the placeholder. Returns (None, None) when the
+    image cannot be processed; the original is then served as-is.
+    """
+    formats = available_formats()
+    if not formats:
+        return None, None
+
+    from PIL import Image, ImageOps
+    try:
+        with storage.open(filename) as fp, Image.open(fp) as source:
+            # Apply camera rotation before throwing the EXIF data away
+            image = ImageOps.exif_transpose(source)
+            image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+            for size, width in VARIANT_WIDTHS.items():
+                resized = _resized(image, width)
+                for fmt in formats:
+                    out = io.BytesIO()
+                    resized.save(out, format=fmt.upper(), quality=FORMAT_QUALITY[fmt])
+                    out.seek(0)
+                    storage.put(variant_filename(filename, size, fmt), out)
+
+            buffer = io.BytesIO()
+            _resized(image, PLACEHOLDER_WIDTH).save(buffer, format='WEBP', quality=30)
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        logger.warning('Could not process image %s: %s', filename, exc)
+        delete_variants(storage, filename, formats)
+        return None, None
+
+    placeholder = 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode()
+    return ','.join(formats), placeholder
+
+
+def delete_variants(storage, filename, formats=None):
+    """Remove the resized copies of an image (the original is left alone)"""
+    for name in variant_filenames(filename, formats or list(FORMAT_QUALITY)):
+        storage.delete(name)
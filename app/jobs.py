@@ -0,0 +1,269 @@
+"""
+Background jobs
+A small SQLite-backed job queue with a pool of worker threads, so slow side
+effects of a request (image processing, file cleanup) run after the
+response has been sent. Failed jobs are retried with backoff.
+A claimed job is leased to its process for JOB_LEASE_SECONDS; only jobs
+whose lease ran out (their worker died) are claimed again. Worker threads
+start with the app's first request, so CLI commands never claim jobs;
+`flask jobs-work` runs a worker on its own.
+"""
+import json
+import logging
+import atexit
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+
+logger = logging.getLogger(__name__)
+
+# Registered task functions, by name
+_tasks = {}
+
+# The queue for the running app (set by init_app)
+_queue = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    last_error TEXT,
+    claimed_by TEXT,
+    claimed_at REAL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_ready ON jobs (status, run_at);
+"""
+
+
+def task(name):
+    """Register a function as a background task under name"""
+    def decorator(func):
+        _tasks[name] = func
+        return func
+    return decorator
+
+
+class JobQueue:
+    """Job storage plus the worker threads that drain it"""
+
+    def __init__(self, app, path, workers=2, max_attempts=3, poll_interval=1.0, lease=300):
+        self.app = app
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+
+    def _connect(self):
+        """One SQLite connection per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, name, *args, max_attempts=None, delay=0):
+        """Add a job to the queue and return its id"""
+        if name not in _tasks:
+            raise KeyError(f'Unknown task: {name}')
+        now = datetime.utcnow().isoformat()
+        cursor = self._connect().execute(
+            "INSERT INTO jobs (name, args, max_attempts, run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (name, json.dumps(args), max_attempts or self.max_attempts,
+             time.time() + delay, now, now)
+        )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def status(self, job_id):
+        """Status row for a job as a dict, or None if it does not exist"""
+        row = self._connect().execute(
+            "SELECT id, name, status, attempts, max_attempts, last_error, created_at, updated_at "
+            "FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def counts(self):
+        """Number of jobs in each status"""
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+        ).fetchall()
+        return {status: count for status, count in rows}
+
+    def _claim(self):
+        """Atomically lease the next due job (or one whose lease expired), or return None"""
+        conn = self._connect()
+        now = time.time()
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # A job whose worker died on its last attempt is not run again
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', last_error = 'Worker lost (lease expired)', "
+                "updated_at = ? WHERE status = 'running' AND claimed_at < ? AND attempts >= max_attempts",
+                (datetime.utcnow().isoformat(), now - self.lease)
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND run_at <= ? "
+                "ORDER BY run_at, id LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                # Left running by a worker that died
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'running' AND claimed_at < ? "
+                    "ORDER BY claimed_at, id LIMIT 1", (now - self.lease,)
+                ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                    "claimed_by = ?, claimed_at = ?, updated_at = ? WHERE id = ?",
+                    (owner, now, datetime.utcnow().isoformat(), row['id'])
+                )
+                row = dict(row, claimed_by=owner, claimed_at=now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row
+
+    def _finish(self, job, error=None):
+        """Record the outcome of a job, scheduling a retry if it failed"""
+        now = datetime.utcnow().isoformat()
+        attempts = job['attempts'] + 1
+        if error is None:
+            status, run_at = 'done', job['run_at']
+        elif attempts < job['max_attempts']:
+            # Exponential backoff: 2s, 4s, 8s, ...
+            status, run_at = 'queued', time.time() + 2 ** attempts
+        else:
+            status, run_at = 'failed', job['run_at']
+        # Only while we still hold the lease: otherwise another worker has the job
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, run_at = ?, last_error = ?, updated_at = ?, "
+            "claimed_by = NULL, claimed_at = NULL "
+            "WHERE id = ? AND claimed_by = ? AND claimed_at = ?",
+            (status, run_at, error, now, job['id'], job['claimed_by'], job['claimed_at'])
+        )
+        if not cursor.rowcount:
+            logger.warning('Job %s (%s) outlived its lease; result not recorded', job['id'], job['name'])
+
+    def run_job(self, job):
+        """Run one claimed job inside an app context"""
+        func = _tasks.get(job['name'])
+        try:
+            if func is None:
+                raise KeyError(f"Unknown task: {job['name']}")
+            with self.app.app_context():
+                func(*json.loads(job['args']))
+        except Exception as exc:
+            logger.exception('Job %s (%s) failed', job['id'], job['name'])
+            self._finish(job, f'{type(exc).__name__}: {exc}')
+        else:
+            self._finish(job)
+
+    def work(self, burst=False):
+        """Process jobs until stopped (or, with burst, until the queue is empty)"""
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is not None:
+                self.run_job(job)
+                continue
+            if burst:
+                return
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        """Start the worker threads (once per process)"""
+        with self._start_lock:
+            if self._threads or not self.workers:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        # Let the current jobs finish when the process exits
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """Ask the worker threads to finish their current job and exit"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+def enqueue(name, *args, **kwargs):
+    """
+    Queue a task to run in the background.
+    With JOB_RUN_INLINE set (or before init_app) the task runs immediately.
+    """
+    if _queue is None or _queue.app.config.get('JOB_RUN_INLINE'):
+        _tasks[name](*args)
+        return None
+    return _queue.enqueue(name, *args, **kwargs)
+
+
+def get_queue():
+    """The queue for the running app"""
+    return _queue
+
+
+def init_app(app):
+    """Create the job queue and start its workers"""
+    global _queue
+    # Importing the task modules registers their tasks
+    from app import tasks  # noqa: F401
+
+    _queue = JobQueue(app, app.config['JOB_QUEUE_PATH'],
+                      workers=app.config['JOB_WORKERS'],
+                      max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+                      lease=app.config['JOB_LEASE_SECONDS'])
+    if not app.config.get('JOB_RUN_INLINE'):
+        # Only a process that serves requests runs workers, not `flask <command>`
+        @app.before_request
+        def start_job_workers():
+            _queue.start()
+    app.cli.add_command(work_command)
+    app.cli.add_command(status_command)
+
+
+@click.command('jobs-work')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+@with_appcontext
+def work_command(burst):
+    """Run a background job worker in this process"""
+    _queue.work(burst=burst)
+
+
+@click.command('jobs-status')
+@with_appcontext
+def status_command():
+    """Show how many background jobs are in each state"""
+    for status, count in sorted(_queue.counts().items()):
+        click.echo(f'{status}: {count}')
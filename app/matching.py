@@ -0,0 +1,310 @@
+"""
+Lost-to-found matching
+Each open item is scored against other users' open items of the opposite
+status in the same category: TF-IDF similarity of title and description, shared location
+words and how close the dates are. The best MATCH_TOP_K candidates are kept
+in the item_matches table for the dashboard and item pages.
+Candidates come from an in-memory inverted index, so only items sharing a
+word or location with the new item are scored. Each process keeps its own
+index and catches up on changes made elsewhere through items.updated_at.
+"""
+import math
+import threading
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from app.search import WORD_RE
+
+# Share of the score given to each signal
+TEXT_WEIGHT = 0.6
+LOCATION_WEIGHT = 0.2
+DATE_WEIGHT = 0.2
+
+# Words too common in item posts to say anything about a match
+STOP_WORDS = frozenset('''
+    a an and are at by for from has have i in is it its lost found my near
+    of on or the this to was with left
+'''.split())
+
+OPPOSITE = {'lost': 'found', 'found': 'lost'}
+
+Doc = namedtuple('Doc', 'id user_id category status date terms location')
+
+
+def _words(text):
+    return [word for word in (w.lower() for w in WORD_RE.findall(text or ''))
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+def _doc(item):
+    """Index entry for an item (or a row with the same columns)"""
+    return Doc(
+        id=item.id,
+        user_id=item.user_id,
+        category=item.category,
+        status=item.status,
+        date=item.date_lost_found,
+        terms=Counter(_words(f'{item.title} {item.description}')),
+        location=frozenset(_words(item.location)),
+    )
+
+
+class MatchIndex:
+    """Inverted index over open items' words and locations"""
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = defaultdict(set)           # (category, status, word) -> item ids
+        self.location_postings = defaultdict(set)  # (category, status, word) -> item ids
+        self.df = Counter()                        # word -> number of items using it
+        self.watermark = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc):
+        with self._lock:
+            self._remove(doc.id)
+            self.docs[doc.id] = doc
+            for word in doc.terms:
+                self.postings[(doc.category, doc.status, word)].add(doc.id)
+                self.df[word] += 1
+            for word in doc.location:
+                self.location_postings[(doc.category, doc.status, word)].add(doc.id)
+
+    def remove(self, item_id):
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        doc = self.docs.pop(item_id, None)
+        if doc is None:
+            return
+        for word in doc.terms:
+            self.postings[(doc.category, doc.status, word)].discard(item_id)
+            self.df[word] -= 1
+        for word in doc.location:
+            self.location_postings[(doc.category, doc.status, word)].discard(item_id)
+
+    def refresh(self):
+        """Apply items added, edited or resolved since the last refresh"""
+        from app.models import Item
+
+        query = db.session.query(Item.id, Item.user_id, Item.category, Item.status, Item.date_lost_found,
+                                 Item.title, Item.description, Item.location,
+                                 Item.is_resolved, Item.updated_at)
+        if self.watermark is None:
+            query = query.filter(Item.is_resolved.is_(False))
+        else:
+            # >= so rows sharing the watermark's timestamp are not missed
+            query = query.filter(Item.updated_at >= self.watermark)
+        for row in query.yield_per(1000):
+            if row.is_resolved:
+                self.remove(row.id)
+            else:
+                self.add(_doc(row))
+            if row.updated_at and (self.watermark is None or row.updated_at > self.watermark):
+                self.watermark = row.updated_at
+
+    def _weights(self, terms):
+        """TF-IDF weights of a bag of words, and their vector length"""
+        total = len(self.docs) + 1
+        weights = {word: (1 + math.log(count)) * (math.log(total / (1 + self.df[word])) + 1)
+                   for word, count in terms.items()}
+        return weights, math.sqrt(sum(w * w for w in weights.values())) or 1.0
+
+    def score(self, doc, window_days, min_score=0.0):
+        """(score, item id) of every candidate for doc posted by someone else, best first"""
+        target = OPPOSITE.get(doc.status)
+        if target is None:
+            return []
+
+        with self._lock:
+            candidates = set()
+            for word in doc.terms:
+                candidates |= self.postings.get((doc.category, target, word), set())
+            for word in doc.location:
+                candidates |= self.location_postings.get((doc.category, target, word), set())
+
+            weights, length = self._weights(doc.terms)
+            results = []
+            for item_id in candidates:
+                other = self.docs[item_id]
+                if other.user_id == doc.user_id:
+                    continue
+                days = abs((other.date - doc.date).days)
+                if days > window_days:
+                    continue
+
+                other_weights, other_length = self._weights(other.terms)
+                text = sum(w * other_weights[word] for word, w in weights.items()
+                           if word in other_weights) / (length * other_length)
+                location = 0.0
+                if doc.location and other.location:
+                    location = len(doc.location & other.location) / len(doc.location | other.location)
+                closeness = 1 - days / (window_days + 1)
+
+                score = TEXT_WEIGHT * text + LOCATION_WEIGHT * location + DATE_WEIGHT * closeness
+                if score >= min_score:
+                    results.append((round(score, 4), item_id))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results
+
+
+def get_index():
+    """Match index of the current app, loaded on first use and kept up to date"""
+    index = current_app.extensions['match_index']
+    index.refresh()
+    return index
+
+
+def _trim(item_id, top_k):
+    """Keep only an item's top_k best matches"""
+    from app.models import ItemMatch
+
+    extra = [row.id for row in db.session.query(ItemMatch.id)
+             .filter_by(item_id=item_id)
+             .order_by(ItemMatch.score.desc(), ItemMatch.id)
+             .offset(top_k)]
+    if extra:
+        ItemMatch.query.filter(ItemMatch.id.in_(extra)).delete(synchronize_session=False)
+
+
+def update_matches(item_id):
+    """
+    Recompute the matches of one item and update the other side of every
+    pair. Called whenever an item is posted, edited, resolved or deleted.
+    Returns the number of matches stored for the item.
+    """
+    from app.models import Item, ItemMatch
+
+    config = current_app.config
+    top_k = config['MATCH_TOP_K']
+    index = get_index()
+
+    # The item's own list is rebuilt below
+    ItemMatch.query.filter_by(item_id=item_id).delete(synchronize_session=False)
+    reverse = ItemMatch.query.filter_by(candidate_id=item_id)
+
+    item = db.session.get(Item, item_id)
+    if item is None or item.is_resolved:
+        index.remove(item_id)
+        reverse.delete(synchronize_session=False)
+        db.session.commit()
+        return 0
+
+    doc = _doc(item)
+    index.add(doc)
+    scored = index.score(doc, config['MATCH_DATE_WINDOW_DAYS'], config['MATCH_MIN_SCORE'])
+
+    # The index can lag behind deletions made by other processes
+    shortlist = scored[:top_k * 2]
+    open_ids = {row.id for row in db.session.query(Item.id).filter(
+        Item.id.in_([candidate for _, candidate in shortlist]), Item.is_resolved.is_(False))}
+    for _, candidate in shortlist:
+        if candidate not in open_ids:
+            index.remove(candidate)
+    best = [(score, candidate) for score, candidate in shortlist if candidate in open_ids][:top_k]
+
+    # Items that list this one keep it while it still qualifies, whether or
+    # not they make its own top_k (the score is the same both ways)
+    now = datetime.utcnow()
+    scores = {candidate: score for score, candidate in scored}
+    listed_by = set()
+    for match in reverse:
+        score = scores.get(match.item_id)
+        if score is None:
+            db.session.delete(match)
+            continue
+        if score != match.score:
+            match.score, match.created_at = score, now
+        listed_by.add(match.item_id)
+
+    for score, candidate in best:
+        db.session.add(ItemMatch(item_id=item_id, candidate_id=candidate, score=score, created_at=now))
+        if candidate not in listed_by:
+            db.session.add(ItemMatch(item_id=candidate, candidate_id=item_id, score=score, created_at=now))
+    db.session.flush()
+    for _, candidate in best:
+        _trim(candidate, top_k)
+    db.session.commit()
+    return len(best)
+
+
+def rematch_all():
+    """Recompute matches for every open item; returns the number of items"""
+    from app.models import Item
+
+    ids = [row.id for row in db.session.query(Item.id).filter(Item.is_resolved.is_(False))
+           .order_by(Item.id)]
+    for item_id in ids:
+        update_matches(item_id)
+    return len(ids)
+
+
+def matches_for(item, limit=None):
+    """Stored matches of an item that are still open, best first"""
+    from sqlalchemy.orm import joinedload
+    from app.models import Item, ItemMatch
+
+    query = ItemMatch.query.filter_by(item_id=item.id)\
+        .join(Item, Item.id == ItemMatch.candidate_id)\
+        .filter(Item.is_resolved.is_(False))\
+        .options(joinedload(ItemMatch.candidate).joinedload(Item.user))\
+        .order_by(ItemMatch.score.desc(), ItemMatch.id)
+    return query.limit(limit or current_app.config['MATCH_TOP_K']).all()
+
+
+def matches_for_user(user_id, limit=10):
+    """Best matches across a user's open items, with both items loaded"""
+    from sqlalchemy.orm import joinedload
+    from app.models import Item, ItemMatch
+
+    candidate = db.aliased(Item)
+    return ItemMatch.query\
+        .join(Item, Item.id == ItemMatch.item_id)\
+        .join(candidate, candidate.id == ItemMatch.candidate_id)\
+        .filter(Item.user_id == user_id, Item.is_resolved.is_(False),
+                candidate.is_resolved.is_(False))\
+        .options(joinedload(ItemMatch.item), joinedload(ItemMatch.candidate))\
+        .order_by(ItemMatch.score.desc(), ItemMatch.id)\
+        .limit(limit).all()
+
+
+def match_version_columns():
+    """
+    Count and newest time of an item's stored matches, as columns to select
+    alongside Item. Together they change whenever the matches change: every
+    rewrite inserts rows with a new time, every removal lowers the count.
+    """
+    from app.models import Item, ItemMatch
+
+    count = db.select(db.func.count(ItemMatch.id))\
+        .where(ItemMatch.item_id == Item.id).scalar_subquery()
+    newest = db.select(db.func.max(ItemMatch.created_at))\
+        .where(ItemMatch.item_id == Item.id).scalar_subquery()
+    return count, newest
+
+
+def init_app(app):
+    """Create the (empty) match index and register the CLI command"""
+    app.extensions['match_index'] = MatchIndex()
+    app.cli.add_command(match_command)
+
+
+@click.command('items-match')
+@click.argument('item_id', type=int, required=False)
+@with_appcontext
+def match_command(item_id):
+    """Recompute matches for one item, or for every open item"""
+    if item_id:
+        click.echo(f'{update_matches(item_id)} match(es) stored for item {item_id}.')
+        return
+    started = datetime.utcnow()
+    count = rematch_all()
+    seconds = (datetime.utcnow() - started).total_seconds()
+    click.echo(f'Matched {count} open item(s) in {seconds:.2f}s.')
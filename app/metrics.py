@@ -0,0 +1,268 @@
+"""
+Request metrics and slow-request profiling
+Every request records its wall time, SQL query count and time, template
+render time and uploaded bytes under its endpoint name. The totals are
+served in the Prometheus text format at /metrics. Each process keeps its
+own totals, so scrape every worker (or run one worker per container).
+With PROFILE_SLOW_REQUESTS on, a sampler thread also records the stacks of
+in-flight requests every PROFILE_INTERVAL_MS; requests slower than
+PROFILE_SLOW_MS have their stacks written as folded lines (one "a;b;c count"
+per stack) to PROFILE_DIR, ready for flamegraph.pl or speedscope.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from flask import (g, request, current_app, abort, has_request_context,
+                   template_rendered, before_render_template)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.querycount import query_count
+
+PREFIX = 'lostfound'
+
+
+class Metrics:
+    """Per-endpoint request totals and a latency histogram, shared by all threads"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.requests = Counter()                # (endpoint, method, status) -> count
+        self.histograms = {}                     # endpoint -> per-bucket counts (+Inf last)
+        self.totals = defaultdict(Counter)       # endpoint -> {'seconds': ..., 'sql_queries': ...}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, method, status, seconds, sql_queries, sql_seconds,
+               template_seconds, upload_bytes):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = [0] * (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[-1] += 1
+            totals = self.totals[endpoint]
+            totals['seconds'] += seconds
+            totals['count'] += 1
+            totals['sql_queries'] += sql_queries
+            totals['sql_seconds'] += sql_seconds
+            totals['template_seconds'] += template_seconds
+            totals['upload_bytes'] += upload_bytes
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            requests = sorted(self.requests.items())
+            histograms = sorted((endpoint, list(counts)) for endpoint, counts in self.histograms.items())
+            totals = sorted((endpoint, dict(counts)) for endpoint, counts in self.totals.items())
+
+        lines = [
+            f'# HELP {PREFIX}_http_requests_total Requests handled, by endpoint, method and status.',
+            f'# TYPE {PREFIX}_http_requests_total counter',
+        ]
+        for (endpoint, method, status), count in requests:
+            lines.append(f'{PREFIX}_http_requests_total'
+                         f'{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+        name = f'{PREFIX}_http_request_duration_seconds'
+        lines += [f'# HELP {name} Wall time of requests, by endpoint.', f'# TYPE {name} histogram']
+        sums = dict(totals)
+        for endpoint, counts in histograms:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_labels(endpoint=endpoint, le=le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(endpoint=endpoint)} {sums[endpoint]["seconds"]:.6f}')
+            lines.append(f'{name}_count{_labels(endpoint=endpoint)} {cumulative}')
+
+        for key, metric, help_text in (
+            ('sql_queries', 'sql_queries_total', 'SQL statements run by requests'),
+            ('sql_seconds', 'sql_duration_seconds_total', 'Time requests spent waiting on SQL'),
+            ('template_seconds', 'template_render_seconds_total', 'Time requests spent rendering templates'),
+            ('upload_bytes', 'upload_bytes_total', 'Bytes of file uploads received'),
+        ):
+            lines += [f'# HELP {PREFIX}_{metric} {help_text}, by endpoint.',
+                      f'# TYPE {PREFIX}_{metric} counter']
+            for endpoint, counts in totals:
+                value = counts.get(key, 0)
+                value = f'{value:.6f}' if isinstance(value, float) else value
+                lines.append(f'{PREFIX}_{metric}{_labels(endpoint=endpoint)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Sampler:
+    """
+    Background thread that samples the Python stacks of request threads.
+    Only threads that registered with start() are looked at, and nothing
+    runs between requests except the sleep.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Begin sampling the calling thread"""
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='request-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Stop sampling the calling thread; returns its Counter of folded stacks"""
+        with self._lock:
+            return self._active.pop(threading.get_ident(), Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[_fold(frame)] += 1
+
+
+def _fold(frame):
+    """Stack of frame as 'outermost;...;innermost' with file:function names"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _write_profile(folder, endpoint, seconds, stacks):
+    """Save one slow request's stacks as a .folded file; returns its path"""
+    os.makedirs(folder, exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(folder, f'{stamp}-{endpoint}-{int(seconds * 1000)}ms.folded')
+    with open(path, 'w') as fp:
+        for stack, count in stacks.most_common():
+            fp.write(f'{stack} {count}\n')
+    return path
+
+
+# SQL time of the current request, from engine events on every engine
+
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_started'] = time.perf_counter()
+
+
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'metrics_started_at' in g:
+        g.metrics_sql_seconds += elapsed
+
+
+# Template render time, from Flask's template signals
+
+def _before_render(app, template, context, **extra):
+    if has_request_context() and 'metrics_started_at' in g:
+        g.metrics_template_started = time.perf_counter()
+
+
+def _after_render(app, template, context, **extra):
+    if not has_request_context():
+        return
+    started = g.pop('metrics_template_started', None)
+    if started is not None:
+        g.metrics_template_seconds += time.perf_counter() - started
+
+
+def init_app(app):
+    """Time every request and serve the totals at METRICS_PATH"""
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    metrics = app.extensions['metrics'] = Metrics(app.config['METRICS_BUCKETS'])
+    sampler = None
+    if app.config.get('PROFILE_SLOW_REQUESTS'):
+        sampler = app.extensions['metrics_sampler'] = Sampler(app.config['PROFILE_INTERVAL_MS'] / 1000)
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started_at = time.perf_counter()
+        g.metrics_queries_before = query_count()
+        g.metrics_sql_seconds = 0.0
+        g.metrics_template_seconds = 0.0
+        if sampler:
+            sampler.start()
+
+    @app.after_request
+    def remember_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record(exc):
+        started = g.pop('metrics_started_at', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        status = g.get('metrics_status', 500 if exc else 200)
+
+        # Multipart bodies are file uploads; other bodies are just forms
+        upload_bytes = 0
+        if request.mimetype == 'multipart/form-data':
+            upload_bytes = request.content_length or 0
+
+        metrics.record(endpoint, request.method, status, seconds,
+                       query_count() - g.metrics_queries_before, g.metrics_sql_seconds,
+                       g.metrics_template_seconds, upload_bytes)
+
+        if sampler:
+            stacks = sampler.stop()
+            if stacks and seconds * 1000 >= app.config['PROFILE_SLOW_MS']:
+                path = _write_profile(app.config['PROFILE_DIR'], endpoint, seconds, stacks)
+                app.logger.warning('Slow request %s %s took %.0f ms; stacks in %s',
+                                   request.method, request.path, seconds * 1000, path)
+
+    app.add_url_rule(app.config['METRICS_PATH'], 'metrics', metrics_view)
+
+
+def metrics_view():
+    """
+    Prometheus scrape endpoint, METRICS_TOKEN as a bearer token. Without a
+    token it is off, except for localhost in debug: behind a reverse proxy
+    every request comes from localhost.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+    elif not current_app.debug:
+        abort(404)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+    body = current_app.extensions['metrics'].render()
+    return current_app.response_class(body, mimetype='text/plain; version=0.0.4')
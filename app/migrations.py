@@ -0,0 +1,376 @@
+"""
+Schema migrations
+The database schema is upgraded by explicit, numbered migrations instead of
+db.create_all() on every start. `flask migrate` applies the pending ones and
+records the version in the schema_version table; app start-up only reads
+that version and warns when the database is behind the code.
+New migrations are appended at the bottom with the next version number.
+"""
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
+from app import db
+
+# (version, description, function) in the order they are applied
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a function(conn) as the upgrade to the given version"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def latest_version():
+    """Schema version this code expects"""
+    return MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """Schema version of the database (0 if it was never migrated)"""
+    if not sa.inspect(conn).has_table('schema_version'):
+        return 0
+    return conn.execute(sa.text('SELECT version FROM schema_version WHERE id = 1')).scalar() or 0
+
+
+def _locked_version(conn):
+    """Lock the version row for this transaction, then read it"""
+    conn.execute(sa.text('UPDATE schema_version SET version = version WHERE id = 1'))
+    return conn.execute(sa.text('SELECT version FROM schema_version WHERE id = 1')).scalar()
+
+
+def upgrade(engine, echo=None):
+    """
+    Apply pending migrations, each in its own transaction. The version row
+    is locked first, so several processes starting at once apply each
+    migration exactly once. An up-to-date database is only read, not locked.
+    Returns the number of migrations applied.
+    """
+    with engine.connect() as conn:
+        if current_version(conn) >= latest_version():
+            return 0
+
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            'CREATE TABLE IF NOT EXISTS schema_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)'
+        ))
+    try:
+        with engine.begin() as conn:
+            conn.execute(sa.text(
+                'INSERT INTO schema_version (id, version) '
+                'SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM schema_version)'
+            ))
+    except IntegrityError:
+        pass  # Another process inserted the row first
+
+    applied = 0
+    for version, description, func in MIGRATIONS:
+        with engine.begin() as conn:
+            if _locked_version(conn) >= version:
+                continue
+            if echo:
+                echo(f'Applying {version}: {description}')
+            func(conn)
+            conn.execute(sa.text('UPDATE schema_version SET version = :v WHERE id = 1'), {'v': version})
+            applied += 1
+    return applied
+
+
+def init_app(app):
+    """Check the schema version and register the migrate command"""
+    app.cli.add_command(migrate_command)
+    with app.app_context():
+        if app.config.get('AUTO_MIGRATE'):
+            upgrade(db.engine)
+            return
+        with db.engine.connect() as conn:
+            version = current_version(conn)
+    if version != latest_version():
+        app.logger.warning('Database schema is at version %s, this code needs %s: run "flask migrate"',
+                           version, latest_version())
+
+
+@click.command('migrate')
+@click.option('--status', is_flag=True, help='Only show the schema version.')
+@with_appcontext
+def migrate_command(status):
+    """Upgrade the database schema to the latest version"""
+    if status:
+        with db.engine.connect() as conn:
+            version = current_version(conn)
+        click.echo(f'Database is at version {version}, latest is {latest_version()}.')
+        return
+    applied = upgrade(db.engine, echo=click.echo)
+    click.echo(f'Applied {applied} migration(s); schema is at version {latest_version()}.')
+
+
+# Helpers for migrations
+
+def add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists"""
+    columns = [col['name'] for col in sa.inspect(conn).get_columns(table)]
+    if column not in columns:
+        conn.execute(sa.text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def create_index(conn, name, table, columns, where=None):
+    """CREATE INDEX unless an index with that name already exists, partial if where is given"""
+    sql = f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'
+    if where:
+        sql += f' WHERE {where}'
+    conn.execute(sa.text(sql))
+
+
+def drop_index(conn, name):
+    """DROP INDEX if it exists"""
+    conn.execute(sa.text(f'DROP INDEX IF EXISTS {name}'))
+
+
+def unset(conn, flag):
+    """
+    Partial index condition for rows where a boolean column is false, written
+    the way queries compare it; None where partial indexes are not supported
+    """
+    if conn.dialect.name == 'sqlite':
+        return f'{flag} = 0'
+    if conn.dialect.name == 'postgresql':
+        return f'NOT {flag}'
+    return None
+
+
+# Migrations
+# Databases created by db.create_all() before migrations existed may already
+# have some of these changes, so each step checks before altering anything.
+
+@migration(1, 'Users, items and messages')
+def _initial_schema(conn):
+    meta = sa.MetaData()
+    sa.Table(
+        'users', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('username', sa.String(80), unique=True, nullable=False, index=True),
+        sa.Column('email', sa.String(120), unique=True, nullable=False, index=True),
+        sa.Column('password_hash', sa.String(255), nullable=False),
+        sa.Column('full_name', sa.String(120)),
+        sa.Column('phone', sa.String(20)),
+        sa.Column('created_at', sa.DateTime),
+    )
+    sa.Table(
+        'items', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('title', sa.String(200), nullable=False),
+        sa.Column('description', sa.Text, nullable=False),
+        sa.Column('category', sa.String(50), nullable=False, index=True),
+        sa.Column('status', sa.String(20), nullable=False, index=True),
+        sa.Column('location', sa.String(200)),
+        sa.Column('date_lost_found', sa.Date, nullable=False),
+        sa.Column('image_filename', sa.String(255)),
+        sa.Column('is_resolved', sa.Boolean, index=True),
+        sa.Column('created_at', sa.DateTime, index=True),
+        sa.Column('updated_at', sa.DateTime),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+    )
+    sa.Table(
+        'messages', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('subject', sa.String(200), nullable=False),
+        sa.Column('body', sa.Text, nullable=False),
+        sa.Column('is_read', sa.Boolean, index=True),
+        sa.Column('created_at', sa.DateTime, index=True),
+        sa.Column('sender_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('receiver_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('item_id', sa.Integer, sa.ForeignKey('items.id')),
+    )
+    meta.create_all(conn)
+
+
+@migration(2, 'Unread message counter on users')
+def _unread_count(conn):
+    add_column(conn, 'users', 'unread_count', "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(sa.text(
+        'UPDATE users SET unread_count = (SELECT count(*) FROM messages '
+        'WHERE messages.receiver_id = users.id AND NOT messages.is_read)'
+    ))
+
+
+@migration(3, 'Image variants and content-addressed uploads')
+def _image_variants(conn):
+    add_column(conn, 'items', 'image_formats', 'VARCHAR(50)')
+    add_column(conn, 'items', 'image_placeholder', 'TEXT')
+    create_index(conn, 'ix_items_image_filename', 'items', ['image_filename'])
+
+
+@migration(4, 'Indexes for keyset pagination')
+def _pagination_indexes(conn):
+    create_index(conn, 'ix_items_open_created', 'items', ['is_resolved', 'created_at', 'id'])
+    create_index(conn, 'ix_items_user_status_created', 'items', ['user_id', 'status', 'created_at', 'id'])
+    create_index(conn, 'ix_messages_receiver_created', 'messages', ['receiver_id', 'created_at', 'id'])
+    create_index(conn, 'ix_messages_sender_created', 'messages', ['sender_id', 'created_at', 'id'])
+
+
+@migration(5, 'Full-text search index for items')
+def _search_index(conn):
+    from app.search import create_index as create_search_index
+    create_search_index(conn)
+
+
+@migration(6, 'Lost and found item matches')
+def _item_matches(conn):
+    meta = sa.MetaData()
+    sa.Table('items', meta, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table(
+        'item_matches', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('item_id', sa.Integer, sa.ForeignKey('items.id'), nullable=False),
+        sa.Column('candidate_id', sa.Integer, sa.ForeignKey('items.id'), nullable=False, index=True),
+        sa.Column('score', sa.Float, nullable=False),
+        sa.Column('created_at', sa.DateTime),
+        sa.UniqueConstraint('item_id', 'candidate_id', name='uq_item_matches_pair'),
+        sa.Index('ix_item_matches_item_score', 'item_id', 'score'),
+    )
+    meta.tables['item_matches'].create(conn, checkfirst=True)
+    # The matcher picks up changed items by updated_at
+    create_index(conn, 'ix_items_updated_at', 'items', ['updated_at'])
+
+
+def _thread_subject(subject):
+    """Subject without any leading 'Re: ' prefixes"""
+    while subject[:4].lower() == 're: ':
+        subject = subject[4:]
+    return subject
+
+
+@migration(7, 'Conversations for message threads')
+def _conversations(conn):
+    meta = sa.MetaData()
+    sa.Table('users', meta, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table('items', meta, sa.Column('id', sa.Integer, primary_key=True))
+    conversations = sa.Table(
+        'conversations', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('subject', sa.String(200), nullable=False),
+        sa.Column('item_id', sa.Integer, sa.ForeignKey('items.id')),
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('last_message_id', sa.Integer),
+    )
+    participants = sa.Table(
+        'conversation_participants', meta,
+        sa.Column('conversation_id', sa.Integer, sa.ForeignKey('conversations.id'), primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), primary_key=True),
+        sa.Column('last_message_at', sa.DateTime),
+        sa.Index('ix_conversation_participants_user_last', 'user_id', 'last_message_at', 'conversation_id'),
+    )
+    messages = sa.Table(
+        'messages', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('subject', sa.String(200)),
+        sa.Column('sender_id', sa.Integer),
+        sa.Column('receiver_id', sa.Integer),
+        sa.Column('item_id', sa.Integer),
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('conversation_id', sa.Integer),
+    )
+    conversations.create(conn, checkfirst=True)
+    participants.create(conn, checkfirst=True)
+    add_column(conn, 'messages', 'conversation_id', 'INTEGER REFERENCES conversations (id)')
+    create_index(conn, 'ix_messages_conversation_created', 'messages',
+                 ['conversation_id', 'created_at', 'id'])
+
+    # Group existing messages into threads: same two people, same item and
+    # the same subject once "Re: " prefixes are removed
+    threads = {}
+    assignments = []
+    rows = conn.execute(sa.select(messages).where(messages.c.conversation_id.is_(None))
+                        .order_by(messages.c.created_at, messages.c.id))
+    for row in rows.fetchall():
+        pair = tuple(sorted((row.sender_id, row.receiver_id)))
+        key = (pair, row.item_id, _thread_subject(row.subject))
+        thread = threads.get(key)
+        if thread is None:
+            conversation_id = conn.execute(conversations.insert().values(
+                subject=key[2], item_id=row.item_id, created_at=row.created_at
+            )).inserted_primary_key[0]
+            conn.execute(participants.insert(), [
+                {'conversation_id': conversation_id, 'user_id': user_id} for user_id in set(pair)
+            ])
+            thread = threads[key] = {'id': conversation_id}
+        thread['last_id'], thread['last_at'] = row.id, row.created_at
+        assignments.append({'message_id': row.id, 'conversation_id': thread['id']})
+
+    if assignments:
+        conn.execute(messages.update().where(messages.c.id == sa.bindparam('message_id'))
+                     .values(conversation_id=sa.bindparam('conversation_id')), assignments)
+    for thread in threads.values():
+        conn.execute(conversations.update().where(conversations.c.id == thread['id'])
+                     .values(last_message_id=thread['last_id']))
+        conn.execute(participants.update().where(participants.c.conversation_id == thread['id'])
+                     .values(last_message_at=thread['last_at']))
+
+
+@migration(8, 'Composite and partial indexes for the hot queries')
+def _hot_query_indexes(conn):
+    create_index(conn, 'ix_items_open_status_created', 'items', ['status', 'created_at', 'id'],
+                 where=unset(conn, 'is_resolved'))
+    create_index(conn, 'ix_items_open_category_created', 'items', ['category', 'created_at', 'id'],
+                 where=unset(conn, 'is_resolved'))
+    create_index(conn, 'ix_messages_receiver_unread', 'messages', ['receiver_id'],
+                 where=unset(conn, 'is_read'))
+    create_index(conn, 'ix_messages_item', 'messages', ['item_id'])
+    # Single-column indexes on booleans only lure the planner away from the ones above
+    drop_index(conn, 'ix_items_is_resolved')
+    drop_index(conn, 'ix_messages_is_read')
+
+
+@migration(9, 'Archive tables for long-resolved items')
+def _archive(conn):
+    meta = sa.MetaData()
+    sa.Table('users', meta, sa.Column('id', sa.Integer, primary_key=True))
+    items = sa.Table(
+        'items', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('is_resolved', sa.Boolean),
+        sa.Column('updated_at', sa.DateTime),
+        sa.Column('resolved_at', sa.DateTime),
+    )
+    sa.Table(
+        'items_archive', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('title', sa.String(200), nullable=False),
+        sa.Column('description', sa.Text, nullable=False),
+        sa.Column('category', sa.String(50), nullable=False),
+        sa.Column('status', sa.String(20), nullable=False),
+        sa.Column('location', sa.String(200)),
+        sa.Column('date_lost_found', sa.Date, nullable=False),
+        sa.Column('image_filename', sa.String(255)),
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('updated_at', sa.DateTime),
+        sa.Column('resolved_at', sa.DateTime),
+        sa.Column('archived_at', sa.DateTime),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+    )
+    sa.Table(
+        'messages_archive', meta,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('subject', sa.String(200), nullable=False),
+        sa.Column('body', sa.Text, nullable=False),
+        sa.Column('is_read', sa.Boolean),
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('sender_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('receiver_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('item_id', sa.Integer),
+        sa.Column('conversation_id', sa.Integer),
+        sa.Column('archived_at', sa.DateTime),
+        sa.Index('ix_messages_archive_item', 'item_id'),
+    )
+    meta.tables['items_archive'].create(conn, checkfirst=True)
+    meta.tables['messages_archive'].create(conn, checkfirst=True)
+
+    add_column(conn, 'items', 'resolved_at', 'DATETIME')
+    # Items resolved before this column existed count from their last change
+    conn.execute(items.update()
+                 .where(items.c.is_resolved == sa.true(), items.c.resolved_at.is_(None))
+                 .values(resolved_at=items.c.updated_at))
+    create_index(conn, 'ix_items_resolved_at', 'items', ['resolved_at'])
@@ -4,8 +4,21 @@ Defines User, Item, and Message tables
 """
 from app import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from app.images import VARIANT_WIDTHS, variant_filename
+from app.passwords import get_hasher
+from app.storage import get_storage, get_cold_storage
+
+
+def _partial_index(name, flag, *columns):
+    """
+    Index over only the rows whose boolean flag is false, matching queries
+    written as filter_by(flag=False). Databases without partial indexes
+    index every row.
+    """
+    return db.Index(name, *columns,
+                    sqlite_where=db.text(f'{flag} = 0'),
+                    postgresql_where=db.text(f'NOT {flag}'))
 
 
 class User(UserMixin, db.Model):
@@ -22,6 +35,7 @@ class User(UserMixin, db.Model):
     full_name = db.Column(db.String(120))
     phone = db.Column(db.String(20))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Kept in sync by app.unread
     
     # Relationships
     items = db.relationship('Item', backref='user', lazy='dynamic', cascade='all, delete-orphan')
@@ -31,12 +45,16 @@ class User(UserMixin, db.Model):
                                        backref='receiver', lazy='dynamic', cascade='all, delete-orphan')
     
     def set_password(self, password):
-        """Hash and set the user's password"""
-        self.password_hash = generate_password_hash(password)
+        """Hash and set the user's password (hashed in the worker pool)"""
+        self.password_hash = get_hasher().hash(password)
     
     def check_password(self, password):
         """Check if provided password matches the hash"""
-        return check_password_hash(self.password_hash, password)
+        return get_hasher().verify(self.password_hash, password)
+    
+    def password_needs_rehash(self):
+        """True if the stored hash uses an outdated method or cost"""
+        return get_hasher().needs_rehash(self.password_hash)
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -47,6 +65,14 @@ class Item(db.Model):
     Item model for lost and found items
     """
     __tablename__ = 'items'
+    __table_args__ = (
+        # Keyset pagination: open items newest first, and a user's items by status
+        db.Index('ix_items_open_created', 'is_resolved', 'created_at', 'id'),
+        db.Index('ix_items_user_status_created', 'user_id', 'status', 'created_at', 'id'),
+        # Open items of one status (home page, browse) or one category (browse)
+        _partial_index('ix_items_open_status_created', 'is_resolved', 'status', 'created_at', 'id'),
+        _partial_index('ix_items_open_category_created', 'is_resolved', 'category', 'created_at', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -55,26 +81,55 @@ class Item(db.Model):
     status = db.Column(db.String(20), nullable=False, default='lost', index=True)  # 'lost' or 'found'
     location = db.Column(db.String(200))  # Where it was lost/found
     date_lost_found = db.Column(db.Date, nullable=False)
-    image_filename = db.Column(db.String(255))  # Stored image filename
-    is_resolved = db.Column(db.Boolean, default=False, index=True)  # Whether item is claimed/returned
+    image_filename = db.Column(db.String(255), index=True)  # Content-addressed blob name (see app/storage.py)
+    image_formats = db.Column(db.String(50))  # Formats of the resized copies, e.g. 'avif,webp'
+    image_placeholder = db.Column(db.Text)  # Tiny data: URI shown while the image loads
+    is_resolved = db.Column(db.Boolean, default=False)  # Whether item is claimed/returned
+    resolved_at = db.Column(db.DateTime, index=True)  # When it was resolved; archived some time after
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Foreign key to User
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
     # Relationships
     messages = db.relationship('Message', backref='item', lazy='dynamic', cascade='all, delete-orphan')
+    matches = db.relationship('ItemMatch', foreign_keys='ItemMatch.item_id', backref='item',
+                              lazy='dynamic', cascade='all, delete-orphan')
+    conversations = db.relationship('Conversation', backref='item', lazy='dynamic', cascade='all, delete-orphan')
+    matched_by = db.relationship('ItemMatch', foreign_keys='ItemMatch.candidate_id', backref='candidate',
+                                 lazy='dynamic', cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Item {self.title}>'
     
     @property
     def image_url(self):
-        """Get the URL path for the item's image"""
+        """Get the URL for the item's image from the storage backend"""
         if self.image_filename:
-            return f'/static/uploads/{self.image_filename}'
+            return get_storage().url(self.image_filename)
         return '/static/images/no-image.png'
+    
+    @property
+    def image_format_list(self):
+        """Formats the resized copies were written in, best first"""
+        return self.image_formats.split(',') if self.image_formats else []
+    
+    def image_variant_url(self, size, fmt=None):
+        """URL of a resized copy of the image, or the original if there is none"""
+        formats = self.image_format_list
+        if not formats:
+            return self.image_url
+        fmt = fmt if fmt in formats else formats[-1]
+        return get_storage().url(variant_filename(self.image_filename, size, fmt))
+    
+    def image_srcset(self, fmt):
+        """srcset attribute value listing every size of the image in one format"""
+        storage = get_storage()
+        return ', '.join(
+            f'{storage.url(variant_filename(self.image_filename, size, fmt))} {width}w'
+            for size, width in VARIANT_WIDTHS.items()
+        )
 
 
 class Message(db.Model):
@@ -82,17 +137,153 @@ class Message(db.Model):
     Message model for communication between users
     """
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Keyset pagination of inbox and sent, newest first
+        db.Index('ix_messages_receiver_created', 'receiver_id', 'created_at', 'id'),
+        db.Index('ix_messages_sender_created', 'sender_id', 'created_at', 'id'),
+        # Loading a conversation's messages in order
+        db.Index('ix_messages_conversation_created', 'conversation_id', 'created_at', 'id'),
+        # Counting a user's unread messages
+        _partial_index('ix_messages_receiver_unread', 'is_read', 'receiver_id'),
+        # Messages about an item (deleting or archiving it)
+        db.Index('ix_messages_item', 'item_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(200), nullable=False)
     body = db.Column(db.Text, nullable=False)
-    is_read = db.Column(db.Boolean, default=False, index=True)
+    is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Foreign keys
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     item_id = db.Column(db.Integer, db.ForeignKey('items.id'))  # Optional: related item
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'))
     
     def __repr__(self):
         return f'<Message {self.subject}>'
+
+
+class ItemMatch(db.Model):
+    """
+    Possible match between a lost and a found item, found by app/matching.py.
+    Each pair is stored twice, once from each item's side.
+    """
+    __tablename__ = 'item_matches'
+    __table_args__ = (
+        db.UniqueConstraint('item_id', 'candidate_id', name='uq_item_matches_pair'),
+        # An item's matches, best first
+        db.Index('ix_item_matches_item_score', 'item_id', 'score'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('items.id'), nullable=False)
+    candidate_id = db.Column(db.Integer, db.ForeignKey('items.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)  # 0 to 1, higher is better
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ItemMatch {self.item_id} -> {self.candidate_id} ({self.score:.2f})>'
+
+
+class Conversation(db.Model):
+    """
+    Thread of messages between two users, optionally about an item.
+    Kept up to date by app/conversations.py.
+    """
+    __tablename__ = 'conversations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('items.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Newest message, for conversation lists (no foreign key: messages point here too)
+    last_message_id = db.Column(db.Integer)
+    
+    # Relationships
+    messages = db.relationship('Message', backref='conversation', lazy='dynamic')
+    participants = db.relationship('ConversationParticipant', backref='conversation',
+                                   cascade='all, delete-orphan')
+    last_message = db.relationship('Message', primaryjoin='Message.id == foreign(Conversation.last_message_id)',
+                                   uselist=False, viewonly=True)
+    
+    def __repr__(self):
+        return f'<Conversation {self.subject}>'
+
+
+class ConversationParticipant(db.Model):
+    """
+    A user taking part in a conversation. Holds a copy of the conversation's
+    last message time so a user's conversations can be listed from one index.
+    """
+    __tablename__ = 'conversation_participants'
+    __table_args__ = (
+        # A user's conversations, most recently active first
+        db.Index('ix_conversation_participants_user_last', 'user_id', 'last_message_at', 'conversation_id'),
+    )
+    
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+    
+    def __repr__(self):
+        return f'<ConversationParticipant {self.user_id} in {self.conversation_id}>'
+
+
+class ItemArchive(db.Model):
+    """
+    Resolved item moved out of the items table by app/archive.py.
+    Read-only: its detail page still works, nothing else refers to it.
+    """
+    __tablename__ = 'items_archive'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Same id the item had
+    title = db.Column(db.String(200), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    location = db.Column(db.String(200))
+    date_lost_found = db.Column(db.Date, nullable=False)
+    image_filename = db.Column(db.String(255))  # Blob name in cold storage
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    resolved_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    user = db.relationship('User')
+    
+    def __repr__(self):
+        return f'<ItemArchive {self.title}>'
+    
+    @property
+    def image_url(self):
+        """URL of the image in cold storage"""
+        if self.image_filename:
+            return get_cold_storage().url(self.image_filename)
+        return '/static/images/no-image.png'
+
+
+class MessageArchive(db.Model):
+    """Message about an archived item, moved out of the messages table with it"""
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_item', 'item_id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)  # Same id the message had
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    is_read = db.Column(db.Boolean)
+    created_at = db.Column(db.DateTime)
+    sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    item_id = db.Column(db.Integer)
+    conversation_id = db.Column(db.Integer)  # Conversations are not kept
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<MessageArchive {self.subject}>'
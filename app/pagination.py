@@ -0,0 +1,146 @@
+"""
+Keyset (cursor) pagination
+Pages through ordered queries by remembering the sort key of the last row
+seen, so every page is an index range scan instead of a COUNT plus OFFSET
+"""
+import base64
+import json
+from datetime import datetime
+from app import db
+
+
+class CursorError(ValueError):
+    """Raised when a cursor string cannot be decoded"""
+
+
+def encode_cursor(values, direction):
+    """Turn a row's sort key into an opaque, URL-safe cursor string"""
+    payload = {
+        'd': direction,
+        'k': [{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in values],
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (values, direction) from a cursor made by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        values = [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v
+                  for v in payload['k']]
+        direction = payload['d']
+    except (ValueError, KeyError, TypeError) as exc:
+        raise CursorError('Invalid cursor') from exc
+    if direction not in ('next', 'prev'):
+        raise CursorError('Invalid cursor')
+    return values, direction
+
+
+class KeysetPage:
+    """One page of results plus the cursors needed to move around"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None,
+                 total=None, total_is_estimate=False):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def approximate_count(query, cap):
+    """
+    Count rows in query, but stop counting at cap.
+    Returns (count, is_estimate); is_estimate is True when the cap was hit.
+    """
+    limited = query.order_by(None).limit(cap + 1).subquery()
+    count = db.session.query(db.func.count()).select_from(limited).scalar()
+    if count > cap:
+        return cap, True
+    return count, False
+
+
+def keyset_query(query, columns, cursor=None, per_page=20, descending=True):
+    """
+    The query keyset_paginate runs for one page: the cursor's range filter,
+    the key ordering and a limit of one extra row. Returns (query, forward),
+    where forward is False when paging backwards (rows come reversed).
+    """
+    direction = 'next'
+    if cursor:
+        values, direction = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise CursorError('Invalid cursor')
+        key = db.tuple_(*columns)
+        bound = db.tuple_(*[db.literal(v, c.type) for v, c in zip(values, columns)])
+        # Moving forward continues in sort order, moving back goes against it
+        if (direction == 'next') == descending:
+            query = query.filter(key < bound)
+        else:
+            query = query.filter(key > bound)
+
+    forward = direction == 'next'
+    scan_descending = descending if forward else not descending
+    order = [c.desc() if scan_descending else c.asc() for c in columns]
+
+    # Fetch one extra row to find out whether there is another page
+    query = query.add_columns(*columns).order_by(None).order_by(*order).limit(per_page + 1)
+    return query, forward
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=20,
+                    descending=True, count_cap=None):
+    """
+    Paginate query by the given sort columns, e.g. (Item.created_at, Item.id).
+    The last column must be unique so every row has a distinct key. Any
+    ordering already on the query is replaced by the key ordering.
+    Pass count_cap to also get an approximate total (counting stops at cap).
+    A query over several columns gives pages of plain row tuples.
+    """
+    width = len(query.column_descriptions)
+    total, total_is_estimate = None, False
+    if count_cap:
+        total, total_is_estimate = approximate_count(query, count_cap)
+
+    page_query, forward = keyset_query(query, columns, cursor, per_page, descending)
+    rows = page_query.all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first_key = list(rows[0][width:])
+        last_key = list(rows[-1][width:])
+        if forward:
+            if has_more:
+                next_cursor = encode_cursor(last_key, 'next')
+            if cursor:
+                prev_cursor = encode_cursor(first_key, 'prev')
+        else:
+            if has_more:
+                prev_cursor = encode_cursor(first_key, 'prev')
+            next_cursor = encode_cursor(last_key, 'next')
+
+    items = [row[0] if width == 1 else tuple(row[:width]) for row in rows]
+    return KeysetPage(items, next_cursor, prev_cursor, total, total_is_estimate)
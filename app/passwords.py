@@ -0,0 +1,166 @@
+"""
+Password hashing
+Hashing is deliberately slow, so it runs in a small pool of worker
+processes instead of on the request thread. The number of logins waiting
+for the pool is capped: past that, requests are turned away quickly
+rather than piling up behind the CPU. The hash method and cost come from
+PASSWORD_HASH_METHOD; hashes made with older settings are upgraded the
+next time their owner logs in.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash, check_password_hash
+
+logger = logging.getLogger(__name__)
+
+
+class HashingBusy(RuntimeError):
+    """Raised when too many password hashes are already waiting"""
+
+
+# Every hasher in this process, for the fork hook below
+_hashers = weakref.WeakSet()
+
+
+class PasswordHasher:
+    """Bounded process pool for password hashing"""
+
+    def __init__(self, method, workers=2, max_pending=16, wait_timeout=2.0):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        _hashers.add(self)
+
+    def _executor(self):
+        """
+        Start the pool on first use, keeping multiprocessing and the fork off
+        the boot path of every worker and CLI command. Workers are forked
+        where possible: spawning would re-run the entry script (or, under
+        uWSGI, the server binary) in each one. A forked worker only runs the
+        executor's loop and werkzeug's hashing, so locks held by the app's
+        other threads at that moment are never needed in it.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                # Imported here to keep them out of app start-up
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+    def _discard(self, pool):
+        """Drop a broken pool so the next call starts a new one"""
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _after_fork(self):
+        """
+        In a child process (a worker of a preloading server) the pool and the
+        locks belong to the parent: start afresh, the pool on first use again
+        """
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        from concurrent.futures.process import BrokenProcessPool
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise HashingBusy('Too many logins in progress')
+        try:
+            pool = self._executor()
+            try:
+                return pool.submit(func, *args).result()
+            except BrokenProcessPool:
+                # A worker died (killed for memory, crashed): retry once on a new pool
+                logger.warning('Password hashing pool broke; starting a new one')
+                self._discard(pool)
+                return self._executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Hash a password with the configured method"""
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """Check a password against a stored hash"""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if a hash was made with a different method or cost"""
+        return password_hash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def _after_fork_in_child():
+    for hasher in list(_hashers):
+        hasher._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_hasher():
+    """Password hasher of the current app"""
+    return current_app.extensions['password_hasher']
+
+
+def init_app(app):
+    """Create the password hasher and register the benchmark command"""
+    app.extensions['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+        wait_timeout=app.config['PASSWORD_HASH_WAIT_TIMEOUT'],
+    )
+    app.cli.add_command(benchmark_command)
+
+
+@click.command('passwords-benchmark')
+@click.option('--logins', default=200, help='Number of password checks to run.')
+@click.option('--concurrency', default=8, help='Simultaneous logins.')
+@with_appcontext
+def benchmark_command(logins, concurrency):
+    """Measure password checks per second with the configured method"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    hasher = get_hasher()
+    stored = hasher.hash('correct horse battery staple')
+
+    # Warm up the pool so process start-up is not measured
+    hasher.verify(stored, 'warm-up')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        results = list(threads.map(lambda _: hasher.verify(stored, 'correct horse battery staple'),
+                                   range(logins)))
+    elapsed = time.perf_counter() - start
+
+    cores = max(1, min(hasher.workers or 1, os.cpu_count() or 1))
+    rate = logins / elapsed
+    click.echo(f'method:          {hasher.method}')
+    click.echo(f'workers:         {hasher.workers or "inline"}')
+    click.echo(f'logins:          {logins} ({sum(results)} ok) in {elapsed:.2f}s')
+    click.echo(f'logins/sec:      {rate:.1f}')
+    click.echo(f'logins/sec/core: {rate / cores:.1f}')
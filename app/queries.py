@@ -0,0 +1,96 @@
+"""
+Shared queries for message and item pages
+Each query eager-loads exactly the related rows its templates read, so a
+list page costs a fixed number of SELECTs no matter how many rows it shows.
+Each one is also checked against an index by `flask check-query-plans`
+(see app/query_plans.py).
+"""
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Message, Item, Conversation, ConversationParticipant, ItemArchive
+
+
+def inbox_messages(user_id):
+    """Messages received by a user, with sender and item loaded"""
+    return Message.query.filter_by(receiver_id=user_id)\
+        .options(joinedload(Message.sender), joinedload(Message.item))
+
+
+def sent_messages(user_id):
+    """Messages sent by a user, with receiver and item loaded"""
+    return Message.query.filter_by(sender_id=user_id)\
+        .options(joinedload(Message.receiver), joinedload(Message.item))
+
+
+def message_or_404(message_id):
+    """A single message with sender, receiver and item loaded"""
+    return Message.query.filter_by(id=message_id)\
+        .options(joinedload(Message.sender),
+                 joinedload(Message.receiver),
+                 joinedload(Message.item))\
+        .first_or_404()
+
+
+def items_with_owner():
+    """Items with their posting user loaded"""
+    return Item.query.options(joinedload(Item.user))
+
+
+def open_items(status=None, category=None):
+    """Unresolved items, optionally of one status and category"""
+    query = Item.query.filter_by(is_resolved=False)
+    if status:
+        query = query.filter_by(status=status)
+    if category:
+        query = query.filter_by(category=category)
+    return query
+
+
+def recent_items(status, limit=6):
+    """Newest open items of one status, for the home page"""
+    return open_items(status=status).order_by(Item.created_at.desc()).limit(limit)
+
+
+def user_items(user_id, status):
+    """A user's items of one status (page them on Item.created_at, Item.id)"""
+    return Item.query.filter_by(user_id=user_id, status=status)
+
+
+def user_status_counts(user_id):
+    """(status, number of items) rows for a user's items"""
+    return db.session.query(Item.status, db.func.count(Item.id))\
+        .filter_by(user_id=user_id)\
+        .group_by(Item.status)
+
+
+def archived_item_or_404(item_id):
+    """A single archived item with its posting user loaded"""
+    return ItemArchive.query.options(joinedload(ItemArchive.user)).filter_by(id=item_id).first_or_404()
+
+
+def conversation_list(user_id):
+    """
+    A user's conversations, one row per conversation, with the item, last
+    message and its sender and receiver loaded. Page it on
+    (ConversationParticipant.last_message_at, ConversationParticipant.conversation_id).
+    """
+    conversation = joinedload(ConversationParticipant.conversation)
+    last_message = conversation.joinedload(Conversation.last_message)
+    return ConversationParticipant.query.filter_by(user_id=user_id)\
+        .options(conversation.joinedload(Conversation.item),
+                 last_message.joinedload(Message.sender),
+                 last_message.joinedload(Message.receiver))
+
+
+def thread_messages(conversation_id, user_id):
+    """
+    Messages of a conversation in order, with senders, the conversation and
+    its item loaded. Empty unless user_id takes part in the conversation.
+    """
+    return Message.query.filter_by(conversation_id=conversation_id)\
+        .join(ConversationParticipant,
+              (ConversationParticipant.conversation_id == Message.conversation_id)
+              & (ConversationParticipant.user_id == user_id))\
+        .options(joinedload(Message.sender),
+                 joinedload(Message.conversation).joinedload(Conversation.item))\
+        .order_by(Message.created_at, Message.id)
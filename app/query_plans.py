@@ -0,0 +1,109 @@
+"""
+Query plan checks
+`flask check-query-plans` runs EXPLAIN QUERY PLAN on the hot queries of the
+home page, browse, dashboard, inbox, sent, unread counts and conversations,
+built by the same functions the routes use, and fails if any of them reads
+a whole table or sorts rows in a temporary B-tree. Run it against a freshly
+migrated database before a release so a dropped or badly ordered index is
+caught before it ships. Full-text search is left out: it sorts by relevance
+on purpose.
+"""
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from app import db
+from app.pagination import encode_cursor, keyset_query
+
+
+def _explain_hook(conn, cursor, statement, parameters, context, executemany):
+    """Connection hook: ask SQLite for the plan instead of running the statement"""
+    return 'EXPLAIN QUERY PLAN ' + statement, parameters
+
+
+def explain(query):
+    """SQLite's plan for a Query or statement, one line per step"""
+    statement = getattr(query, 'statement', query)
+    with db.engine.connect() as conn:
+        # Bound parameters are kept, so partial indexes are judged as at run time
+        event.listen(conn, 'before_cursor_execute', _explain_hook, retval=True)
+        result = conn.execute(statement)
+        return [row[3] for row in result.cursor.fetchall()]
+
+
+def problems(plan):
+    """
+    Steps of a plan that sort in a temporary B-tree or read a whole table.
+    Walking a whole index to get rows in order ("SCAN t USING INDEX") still
+    reads every row, so it counts; SEARCH steps seek into an index.
+    """
+    found = []
+    for step in plan:
+        words = step.replace('SCAN TABLE', 'SCAN').split()
+        if 'TEMP B-TREE' in step:
+            found.append(step)
+        elif words[0] == 'SCAN' and not words[1].startswith('('):
+            found.append(step)
+    return found
+
+
+def _pages(name, query, columns, descending=True):
+    """The first, a next and a previous page of query, as keyset_paginate runs them"""
+    key = [datetime.utcnow()] + [0] * (len(columns) - 1)
+    yield f'{name} (first page)', keyset_query(query, columns, descending=descending)[0]
+    for direction in ('next', 'prev'):
+        cursor = encode_cursor(key, direction)
+        yield f'{name} ({direction} page)', keyset_query(query, columns, cursor, descending=descending)[0]
+
+
+def hot_queries(user_id=1, conversation_id=1):
+    """(name, query) of every query checked"""
+    from app.models import Item, Message, ConversationParticipant
+    from app.queries import (recent_items, open_items, user_items, user_status_counts,
+                             inbox_messages, sent_messages, conversation_list, thread_messages)
+    from app.unread import unread_query
+
+    item_key = (Item.created_at, Item.id)
+    message_key = (Message.created_at, Message.id)
+
+    yield 'home: recent items', recent_items('lost')
+    yield from _pages('browse', open_items(), item_key)
+    yield from _pages('browse by status', open_items(status='lost'), item_key)
+    yield from _pages('browse by category', open_items(category='Keys'), item_key)
+    yield from _pages('browse by status and category', open_items('lost', 'Keys'), item_key)
+    yield from _pages('dashboard', user_items(user_id, 'lost'), item_key)
+    yield 'dashboard: counts by status', user_status_counts(user_id)
+    yield from _pages('inbox', inbox_messages(user_id), message_key)
+    yield from _pages('sent', sent_messages(user_id), message_key)
+    yield 'unread count', unread_query(user_id)
+    yield from _pages('conversations', conversation_list(user_id),
+                      (ConversationParticipant.last_message_at, ConversationParticipant.conversation_id))
+    yield 'conversation thread', thread_messages(conversation_id, user_id)
+
+
+def init_app(app):
+    app.cli.add_command(check_command)
+
+
+@click.command('check-query-plans')
+@click.option('--verbose', '-v', is_flag=True, help='Print every plan, not only failing ones.')
+@with_appcontext
+def check_command(verbose):
+    """Fail if a hot query scans a whole table or sorts in a temporary B-tree"""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Query plans can only be checked on SQLite.')
+
+    checked = failed = 0
+    for name, query in hot_queries():
+        plan = explain(query)
+        bad = problems(plan)
+        checked += 1
+        failed += bool(bad)
+        if bad or verbose:
+            click.echo(f'{"FAIL" if bad else "ok  "} {name}')
+            for step in plan:
+                click.echo(f'       {"!" if step in bad else " "} {step}')
+
+    if failed:
+        raise click.ClickException(f'{failed} of {checked} hot queries scan a table or sort in a temp B-tree.')
+    click.echo(f'All {checked} hot queries use an index and need no temp B-tree sort.')
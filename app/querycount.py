@@ -0,0 +1,45 @@
+"""
+Per-request SQL query counting
+Counts the statements each request sends to the database and, in debug
+mode, fails any request that goes over QUERY_COUNT_LIMIT so N+1 query
+patterns are caught during development
+"""
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a request runs more queries than QUERY_COUNT_LIMIT"""
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """Engine hook: add one to the current request's query count"""
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def query_count():
+    """Number of queries run so far by the current request"""
+    return g.get('query_count', 0)
+
+
+def init_app(app):
+    """Start counting queries, and enforce the budget in debug mode"""
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+    
+    limit = app.config.get('QUERY_COUNT_LIMIT')
+    if not (app.debug and limit):
+        return
+    
+    @app.after_request
+    def check_query_budget(response):
+        """Fail the request if it ran more queries than allowed"""
+        count = query_count()
+        if count > limit:
+            raise QueryBudgetExceeded(
+                f'{request.endpoint} ran {count} queries (limit {limit}); '
+                'look for lazy-loaded relationships in the template'
+            )
+        return response
@@ -0,0 +1,111 @@
+"""
+Read replicas
+Requests to read-only routes (READ_REPLICA_ROUTES) run their SELECTs on one
+of the DATABASE_REPLICA_URLS; everything else uses the primary database.
+Once a request writes, the rest of it stays on the primary, and so do the
+same visitor's next requests for REPLICA_STICKY_SECONDS, so people always
+see their own changes even if a replica is lagging behind.
+"""
+import itertools
+import threading
+import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, create_engine, event
+
+# Flask session key holding the time until which this visitor uses the primary
+STICKY_KEY = '_db_primary_until'
+
+
+class ReplicaSet:
+    """Engines for the read replicas, handed out round-robin"""
+
+    def __init__(self, engines):
+        self.engines = engines
+        self._cycle = itertools.cycle(engines)
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            return next(self._cycle)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def _route_allowed():
+    """True if the current request may read from a replica"""
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    if 'replicas' not in current_app.extensions:
+        return False
+    if session.get(STICKY_KEY, 0) > time.time():
+        return False
+    routes = current_app.config.get('READ_REPLICA_ROUTES') or ()
+    return request.endpoint in routes or request.blueprint in routes
+
+
+class RoutingSession(Session):
+    """Session that sends reads on read-only routes to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or not _route_allowed() or g.get('db_use_primary'):
+            return primary
+
+        # Only plain SELECTs outside a flush may go to a replica
+        if self._flushing or not isinstance(clause, Select):
+            g.db_use_primary = True
+            return primary
+        if 'db_replica' not in g:
+            # One replica per request, so its reads are consistent
+            g.db_replica = current_app.extensions['replicas'].next()
+        return g.db_replica
+
+
+def use_primary():
+    """Send the rest of this request's queries to the primary"""
+    g.db_use_primary = True
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _remember_write(session_, flush_context, instances):
+    session_.info['db_wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_bulk_update')
+@event.listens_for(RoutingSession, 'after_bulk_delete')
+def _remember_bulk_write(update_context):
+    update_context.session.info['db_wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(session_):
+    """After a commit, read this visitor's own writes from the primary"""
+    if not session_.info.pop('db_wrote', False) or not has_request_context():
+        return
+    seconds = current_app.config.get('REPLICA_STICKY_SECONDS', 0)
+    if seconds and 'replicas' in current_app.extensions:
+        session[STICKY_KEY] = time.time() + seconds
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_write(session_):
+    session_.info.pop('db_wrote', None)
+
+
+def init_app(app):
+    """Create engines for the configured read replicas"""
+    urls = app.config.get('DATABASE_REPLICA_URLS') or []
+    if not urls:
+        return
+
+    from app.database import apply_sqlite_pragmas
+    options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    engines = []
+    for url in urls:
+        engine = create_engine(url, **options)
+        apply_sqlite_pragmas(engine, app.config.get('SQLITE_PRAGMAS'))
+        engines.append(engine)
+    app.extensions['replicas'] = ReplicaSet(engines)
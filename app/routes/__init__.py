@@ -2,24 +2,26 @@
 Routes package initialization
 Imports all route blueprints
 """
-from flask import Blueprint, render_template, send_from_directory, current_app
+from flask import Blueprint, render_template, send_from_directory, current_app, abort, request, jsonify
 from flask_login import current_user
 import os
+from app.cache import cached_page, listing_version
+from app.conditional import conditional
 
 # Main blueprint for homepage
 bp = Blueprint('main', __name__)
 
 
 @bp.route('/')
+@conditional(lambda: (listing_version(), None))
+@cached_page()
 def index():
     """Homepage route"""
-    from app.models import Item
+    from app.queries import recent_items
     
     # Get recent items (6 most recent)
-    recent_lost = Item.query.filter_by(status='lost', is_resolved=False)\
-        .order_by(Item.created_at.desc()).limit(6).all()
-    recent_found = Item.query.filter_by(status='found', is_resolved=False)\
-        .order_by(Item.created_at.desc()).limit(6).all()
+    recent_lost = recent_items('lost').all()
+    recent_found = recent_items('found').all()
     
     return render_template('index.html', 
                          recent_lost=recent_lost,
@@ -32,6 +34,56 @@ def about():
     return render_template('about.html')
 
 
+@bp.route('/suggest')
+def suggest():
+    """Typeahead suggestions: ?kind=items|locations|users&q=what was typed so far"""
+    from app.suggest import KINDS, get_suggest_index
+    
+    kind = request.args.get('kind', 'items')
+    if kind not in KINDS:
+        abort(400)
+    # Usernames are only offered to people who can message them
+    if kind == 'users' and not current_user.is_authenticated:
+        abort(401)
+    
+    limit = request.args.get('limit', current_app.config['SUGGEST_LIMIT'], type=int)
+    limit = max(1, min(limit, 20))
+    suggestions = get_suggest_index().suggest(kind, request.args.get('q', ''), limit)
+    
+    response = jsonify(suggestions)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['SUGGEST_CACHE_SECONDS']
+    return response
+
+
+# Serve uploaded images. Stored names are content hashes, so a URL always
+# refers to the same bytes and browsers may cache it forever.
+@bp.route('/uploads/<path:filename>')
+def upload(filename):
+    # Only the local storage backend serves files through the app
+    if current_app.config['STORAGE_BACKEND'] != 'local':
+        abort(404)
+    response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename,
+                                   max_age=current_app.config['UPLOAD_CACHE_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Images of archived items, when cold storage is a local folder
+@bp.route('/archive/uploads/<path:filename>')
+def archived_upload(filename):
+    from app.storage import LocalStorage, get_cold_storage
+    storage = get_cold_storage()
+    if not isinstance(storage, LocalStorage):
+        abort(404)
+    response = send_from_directory(storage.folder, filename,
+                                   max_age=current_app.config['UPLOAD_CACHE_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 # Serve favicon from project-level assets folder
 @bp.route('/favicon.ico')
 def favicon():
@@ -0,0 +1,306 @@
+"""
+JSON API (version 1)
+Read-only access to items, messages and users for the mobile app and kiosk
+screens. Lists are cursor-paginated, ?fields= picks the fields to return,
+and rows are read as plain column tuples rather than ORM objects. Responses
+carry an ETag and are gzip-compressed when the client accepts it.
+"""
+import gzip
+import json
+from datetime import datetime
+from flask import Blueprint, request, current_app, abort
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from app import db
+from app.models import Item, Message, User
+from app.cache import listing_version, normalized_args
+from app.conditional import conditional
+from app.pagination import keyset_paginate, CursorError
+from app.routes.items import item_validator
+from app.search import search_items
+from app.storage import get_storage
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+Sender = db.aliased(User, name='sender')
+Receiver = db.aliased(User, name='receiver')
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def _image_url(value):
+    return get_storage().url(value) if value else None
+
+
+def _fields(**columns):
+    """
+    Field name -> (column, converter), worked out once at import time.
+    Dates and datetimes are converted to ISO 8601 strings.
+    """
+    fields = {}
+    for name, spec in columns.items():
+        column, converter = spec if isinstance(spec, tuple) else (spec, None)
+        if converter is None and isinstance(column.type, (db.Date, db.DateTime)):
+            converter = _isoformat
+        fields[name] = (column.label(name), converter)
+    return fields
+
+
+ITEM_FIELDS = _fields(
+    id=Item.id,
+    title=Item.title,
+    description=Item.description,
+    category=Item.category,
+    status=Item.status,
+    location=Item.location,
+    date_lost_found=Item.date_lost_found,
+    image_url=(Item.image_filename, _image_url),
+    is_resolved=Item.is_resolved,
+    created_at=Item.created_at,
+    updated_at=Item.updated_at,
+    user_id=Item.user_id,
+    owner=User.username,
+)
+
+MESSAGE_FIELDS = _fields(
+    id=Message.id,
+    subject=Message.subject,
+    body=Message.body,
+    is_read=Message.is_read,
+    created_at=Message.created_at,
+    item_id=Message.item_id,
+    conversation_id=Message.conversation_id,
+    sender_id=Message.sender_id,
+    sender=Sender.username,
+    receiver_id=Message.receiver_id,
+    receiver=Receiver.username,
+)
+
+USER_FIELDS = _fields(
+    id=User.id,
+    username=User.username,
+    created_at=User.created_at,
+)
+
+# Names are only shown to logged-in users, as on the HTML pages
+MEMBER_USER_FIELDS = dict(USER_FIELDS, **_fields(
+    full_name=User.full_name,
+))
+
+# Only shown to the user themselves
+OWN_USER_FIELDS = dict(MEMBER_USER_FIELDS, **_fields(
+    email=User.email,
+    phone=User.phone,
+    unread_count=User.unread_count,
+))
+
+
+def _error(status, message):
+    """Abort with a JSON error body"""
+    abort(current_app.response_class(_dumps({'error': message}), status=status,
+                                     mimetype='application/json'))
+
+
+def _dumps(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def _json(payload):
+    return current_app.response_class(_dumps(payload), mimetype='application/json')
+
+
+def _selected(fields):
+    """(names, columns, converters) for the ?fields= the client asked for"""
+    wanted = request.args.get('fields')
+    names = [name.strip() for name in wanted.split(',') if name.strip()] if wanted else list(fields)
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        _error(400, f'Unknown field(s): {", ".join(unknown)}. Available: {", ".join(fields)}')
+    columns = [fields[name][0] for name in names]
+    converters = [fields[name][1] for name in names]
+    return names, columns, converters
+
+
+def _serialize(row, names, converters):
+    return {name: convert(value) if convert else value
+            for name, value, convert in zip(names, row, converters)}
+
+
+def _per_page():
+    try:
+        per_page = int(request.args.get('per_page', current_app.config['API_PER_PAGE']))
+    except ValueError:
+        _error(400, 'per_page must be a number')
+    return max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+
+
+def _page(query, names, converters, columns, descending=True):
+    """One page of a list endpoint as a JSON response"""
+    try:
+        page = keyset_paginate(query, columns, cursor=request.args.get('cursor'),
+                               per_page=_per_page(), descending=descending)
+    except CursorError:
+        _error(400, 'Invalid cursor')
+    if len(names) == 1:
+        rows = [(row,) for row in page.items]
+    else:
+        rows = page.items
+    return _json({
+        'data': [_serialize(row, names, converters) for row in rows],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    })
+
+
+def _login_required():
+    if not current_user.is_authenticated:
+        _error(401, 'Login required')
+
+
+@bp.route('/items')
+@conditional(lambda: (listing_version(), None))
+def items():
+    """
+    Items, newest first. Filters: status, category, q (search) and
+    resolved ('false' by default, 'true' or 'all'). With updated_since
+    (ISO 8601) items come oldest change first, including resolved ones
+    unless resolved says otherwise, so a client can sync what changed.
+    Deleted items simply disappear and never show up here, so a syncing
+    client must also do a full resync now and then to drop them.
+    """
+    names, columns, converters = _selected(ITEM_FIELDS)
+    query = db.session.query(*columns).select_from(Item)
+    if 'owner' in names:
+        query = query.join(User, User.id == Item.user_id)
+
+    updated_since = request.args.get('updated_since')
+    resolved = request.args.get('resolved', 'all' if updated_since else 'false')
+    if resolved != 'all':
+        query = query.filter(Item.is_resolved == (resolved == 'true'))
+    for name in ('status', 'category'):
+        if request.args.get(name):
+            query = query.filter(getattr(Item, name) == request.args[name])
+
+    if updated_since:
+        try:
+            since = datetime.fromisoformat(updated_since)
+        except ValueError:
+            _error(400, 'updated_since must be an ISO 8601 date and time')
+        query = query.filter(Item.updated_at > since)
+        return _page(query, names, converters, (Item.updated_at, Item.id), descending=False)
+
+    rank = None
+    if request.args.get('q'):
+        query, rank = search_items(query, request.args['q'])
+    if rank is not None:
+        return _page(query, names, converters, (rank, Item.id), descending=False)
+    return _page(query, names, converters, (Item.created_at, Item.id))
+
+
+def _item_version(item_id):
+    """Version of an item response: the item's version plus the chosen fields"""
+    version, last_modified = item_validator(item_id)
+    return f'{version}?{normalized_args()}', last_modified
+
+
+@bp.route('/items/<int:item_id>')
+@conditional(_item_version)
+def item(item_id):
+    """A single item"""
+    names, columns, converters = _selected(ITEM_FIELDS)
+    query = db.session.query(*columns).select_from(Item).filter(Item.id == item_id)
+    if 'owner' in names:
+        query = query.join(User, User.id == Item.user_id)
+    row = query.first()
+    if row is None:
+        _error(404, 'Item not found')
+    return _json(_serialize(row, names, converters))
+
+
+def _message_query(names, columns):
+    query = db.session.query(*columns).select_from(Message)
+    if 'sender' in names:
+        query = query.join(Sender, Sender.id == Message.sender_id)
+    if 'receiver' in names:
+        query = query.join(Receiver, Receiver.id == Message.receiver_id)
+    return query
+
+
+@bp.route('/messages')
+def messages():
+    """The current user's messages, newest first; box is 'inbox' (default) or 'sent'"""
+    _login_required()
+    names, columns, converters = _selected(MESSAGE_FIELDS)
+    box = request.args.get('box', 'inbox')
+    if box not in ('inbox', 'sent'):
+        _error(400, 'box must be inbox or sent')
+    owner_column = Message.receiver_id if box == 'inbox' else Message.sender_id
+    query = _message_query(names, columns).filter(owner_column == current_user.id)
+    return _page(query, names, converters, (Message.created_at, Message.id))
+
+
+@bp.route('/messages/<int:message_id>')
+def message(message_id):
+    """A single message (reading it here does not mark it as read)"""
+    _login_required()
+    names, columns, converters = _selected(MESSAGE_FIELDS)
+    row = _message_query(names, columns).filter(
+        Message.id == message_id,
+        db.or_(Message.sender_id == current_user.id, Message.receiver_id == current_user.id),
+    ).first()
+    if row is None:
+        _error(404, 'Message not found')
+    return _json(_serialize(row, names, converters))
+
+
+@bp.route('/users/me')
+def me():
+    """The current user, including contact details"""
+    _login_required()
+    return _user(current_user.id, OWN_USER_FIELDS)
+
+
+@bp.route('/users/<int:user_id>')
+def user(user_id):
+    """Profile of a user; full_name needs a login"""
+    fields = MEMBER_USER_FIELDS if current_user.is_authenticated else USER_FIELDS
+    return _user(user_id, fields)
+
+
+def _user(user_id, fields):
+    names, columns, converters = _selected(fields)
+    row = db.session.query(*columns).filter(User.id == user_id).first()
+    if row is None:
+        _error(404, 'User not found')
+    return _json(_serialize(row, names, converters))
+
+
+@bp.errorhandler(HTTPException)
+def http_error(exc):
+    """Errors from API views as JSON instead of HTML pages"""
+    if exc.response is not None:
+        return exc.response
+    return _json({'error': exc.description}), exc.code
+
+
+@bp.after_request
+def finish(response):
+    """Add an ETag (answering If-None-Match) and gzip the body"""
+    if request.method == 'GET' and response.status_code == 200:
+        if response.get_etag()[0] is None:
+            response.add_etag(weak=True)
+        response.make_conditional(request)
+
+    response.vary.add('Accept-Encoding')
+    if (response.status_code == 200
+            and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers
+            and request.accept_encodings['gzip']
+            and response.content_length is not None
+            and response.content_length >= current_app.config['API_GZIP_MIN_SIZE']):
+        response.set_data(gzip.compress(response.get_data(),
+                                        compresslevel=current_app.config['API_GZIP_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
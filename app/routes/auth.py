@@ -5,7 +5,8 @@ Handles user registration, login, and logout
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
 from app import db
-from app.models import User
+from app.models import User, Item
+from app.passwords import HashingBusy
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -55,7 +56,11 @@ def register():
             full_name=full_name,
             phone=phone
         )
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except HashingBusy:
+            flash('Too many people are signing up right now. Please try again in a moment.', 'error')
+            return render_template('auth/register.html'), 503
         
         # Save to database
         db.session.add(user)
@@ -89,10 +94,24 @@ def login():
         user = User.query.filter_by(username=username).first()
         
         # Check credentials
-        if user is None or not user.check_password(password):
+        try:
+            valid = user is not None and user.check_password(password)
+        except HashingBusy:
+            flash('Too many people are logging in right now. Please try again in a moment.', 'error')
+            return render_template('auth/login.html'), 503
+        
+        if not valid:
             flash('Invalid username or password.', 'error')
             return render_template('auth/login.html')
         
+        # Upgrade hashes made with older settings while we have the password
+        if user.password_needs_rehash():
+            try:
+                user.set_password(password)
+                db.session.commit()
+            except HashingBusy:
+                pass  # Try again next login
+        
         # Log in user
         login_user(user, remember=remember)
         
@@ -120,4 +139,5 @@ def logout():
 @login_required
 def profile():
     """User profile page"""
-    return render_template('auth/profile.html')
+    item_count = Item.query.filter_by(user_id=current_user.id).count()
+    return render_template('auth/profile.html', item_count=item_count)
@@ -2,16 +2,27 @@
 Item routes
 Handles browsing, posting, searching, and managing lost/found items
 """
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, abort
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
-from app import db
-from app.models import Item, User
+from app import db, jobs, unread
+from app.models import Item, ItemArchive, Message, User
+from app.cache import cached_page, listing_version
+from app.conditional import conditional
+from app.matching import matches_for, matches_for_user, match_version_columns
+from app.pagination import keyset_paginate, CursorError
+from app.queries import items_with_owner, archived_item_or_404, open_items, user_items, user_status_counts
+from app.search import search_items
+from app.storage import save_upload
 from datetime import datetime
-import os
 
 bp = Blueprint('items', __name__, url_prefix='/items')
 
+# Categories offered on the post, edit and browse forms
+CATEGORIES = [
+    'Electronics', 'Books', 'Clothing', 'Accessories',
+    'Keys', 'Bags', 'Documents', 'Sports Equipment', 'Other'
+]
+
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -20,51 +31,43 @@ def allowed_file(filename):
 
 
 @bp.route('/browse')
+@conditional(lambda: (listing_version(), None))
+@cached_page()
 def browse():
     """Browse all items with filtering and search"""
     # Get query parameters
     status_filter = request.args.get('status', 'all')  # 'all', 'lost', 'found'
     category_filter = request.args.get('category', 'all')
     search_query = request.args.get('q', '')
-    page = request.args.get('page', 1, type=int)
-    
-    # Start with base query
-    query = Item.query.filter_by(is_resolved=False)
-    
-    # Apply status filter
-    if status_filter != 'all':
-        query = query.filter_by(status=status_filter)
+    cursor = request.args.get('cursor')
     
-    # Apply category filter
-    if category_filter != 'all':
-        query = query.filter_by(category=category_filter)
+    # Open items, filtered by status and category
+    query = open_items(status=status_filter if status_filter != 'all' else None,
+                       category=category_filter if category_filter != 'all' else None)
     
-    # Apply search filter
+    # Apply search filter (full-text index, best matches first)
+    rank = None
     if search_query:
-        search = f'%{search_query}%'
-        query = query.filter(
-            db.or_(
-                Item.title.ilike(search),
-                Item.description.ilike(search),
-                Item.location.ilike(search)
-            )
-        )
-    
-    # Order by most recent first
-    query = query.order_by(Item.created_at.desc())
+        query, rank = search_items(query, search_query)
     
-    # Paginate results
-    items = query.paginate(page=page, per_page=current_app.config['ITEMS_PER_PAGE'], error_out=False)
+    # Search results are ordered by relevance, everything else most recent first
+    if rank is not None:
+        columns, descending = (rank, Item.id), False
+    else:
+        columns, descending = (Item.created_at, Item.id), True
     
-    # Categories for filter dropdown
-    categories = [
-        'Electronics', 'Books', 'Clothing', 'Accessories', 
-        'Keys', 'Bags', 'Documents', 'Sports Equipment', 'Other'
-    ]
+    # Paginate results with a cursor instead of OFFSET
+    try:
+        items = keyset_paginate(query, columns, cursor=cursor,
+                                per_page=current_app.config['ITEMS_PER_PAGE'],
+                                descending=descending,
+                                count_cap=current_app.config['PAGINATION_COUNT_CAP'])
+    except CursorError:
+        abort(400)
     
     return render_template('items/browse.html',
                          items=items,
-                         categories=categories,
+                         categories=CATEGORIES,
                          status_filter=status_filter,
                          category_filter=category_filter,
                          search_query=search_query)
@@ -93,19 +96,16 @@ def post():
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename and allowed_file(file.filename):
-                # Create unique filename
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                image_filename = f"{current_user.id}_{timestamp}_{filename}"
-                
-                # Save file
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(filepath)
+                # Save file under its content hash (resized copies are made in the background)
+                image_filename = save_upload(file)
         
         # Parse date
         try:
             date_obj = datetime.strptime(date_lost_found, '%Y-%m-%d').date()
         except ValueError:
+            # The upload is not used by any item, so let it be cleaned up
+            if image_filename:
+                jobs.enqueue('delete_image', image_filename, delay=current_app.config['IMAGE_DELETE_DELAY'])
             flash('Invalid date format.', 'error')
             return render_template('items/post.html')
         
@@ -125,22 +125,41 @@ def post():
         db.session.add(item)
         db.session.commit()
         
+        if image_filename:
+            jobs.enqueue('process_item_image', item.id, image_filename)
+        jobs.enqueue('match_item', item.id)
+        
         flash(f'Your {status} item has been posted successfully!', 'success')
         return redirect(url_for('items.detail', item_id=item.id))
     
     # GET request - show form
-    categories = [
-        'Electronics', 'Books', 'Clothing', 'Accessories',
-        'Keys', 'Bags', 'Documents', 'Sports Equipment', 'Other'
-    ]
-    return render_template('items/post.html', categories=categories)
+    return render_template('items/post.html', categories=CATEGORIES)
+
+
+def item_validator(item_id):
+    """Version of an item's detail page: changes when the item or its matches change"""
+    row = db.session.query(Item.updated_at, *match_version_columns()).filter(Item.id == item_id).first()
+    if row is None or row[0] is None:
+        # Archived items never change again
+        archived_at = db.session.query(ItemArchive.archived_at).filter_by(id=item_id).scalar()
+        if archived_at is None:
+            abort(404)
+        return f'archived|{archived_at.isoformat()}', archived_at
+    updated_at, match_count, matched_at = row
+    last_modified = max(updated_at, matched_at) if matched_at else updated_at
+    return f'{updated_at.isoformat()}|{match_count}|{matched_at}', last_modified
 
 
 @bp.route('/<int:item_id>')
+@conditional(item_validator)
 def detail(item_id):
     """View details of a specific item"""
-    item = Item.query.get_or_404(item_id)
-    return render_template('items/detail.html', item=item)
+    item = items_with_owner().filter_by(id=item_id).first()
+    if item is None:
+        # Long-resolved items have moved to the archive
+        return render_template('items/archived.html', item=archived_item_or_404(item_id))
+    matches = matches_for(item) if not item.is_resolved else []
+    return render_template('items/detail.html', item=item, matches=matches)
 
 
 @bp.route('/<int:item_id>/edit', methods=['GET', 'POST'])
@@ -168,32 +187,33 @@ def edit(item_id):
             item.date_lost_found = datetime.strptime(date_str, '%Y-%m-%d').date()
         
         # Handle new image upload
+        old_image = new_image = None
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename and allowed_file(file.filename):
-                # Delete old image if exists
-                if item.image_filename:
-                    old_path = os.path.join(current_app.config['UPLOAD_FOLDER'], item.image_filename)
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
+                # Old image is deleted in the background once the edit is saved
+                old_image = item.image_filename
                 
-                # Save new image
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                image_filename = f"{current_user.id}_{timestamp}_{filename}"
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(filepath)
-                item.image_filename = image_filename
+                # Save new image under its content hash
+                new_image = save_upload(file)
+                if new_image != old_image:
+                    item.image_filename = new_image
+                    item.image_formats = item.image_placeholder = None
+                else:
+                    old_image = new_image = None
         
         db.session.commit()
+        
+        if new_image:
+            jobs.enqueue('process_item_image', item.id, new_image)
+        if old_image:
+            jobs.enqueue('delete_image', old_image, delay=current_app.config['IMAGE_DELETE_DELAY'])
+        jobs.enqueue('match_item', item.id)
+        
         flash('Item updated successfully!', 'success')
         return redirect(url_for('items.detail', item_id=item_id))
     
-    categories = [
-        'Electronics', 'Books', 'Clothing', 'Accessories',
-        'Keys', 'Bags', 'Documents', 'Sports Equipment', 'Other'
-    ]
-    return render_template('items/edit.html', item=item, categories=categories)
+    return render_template('items/edit.html', item=item, categories=CATEGORIES)
 
 
 @bp.route('/<int:item_id>/resolve', methods=['POST'])
@@ -208,8 +228,12 @@ def resolve(item_id):
         return redirect(url_for('items.detail', item_id=item_id))
     
     item.is_resolved = True
+    item.resolved_at = datetime.utcnow()
     db.session.commit()
     
+    # Take it out of other items' matches
+    jobs.enqueue('match_item', item.id)
+    
     flash('Item marked as resolved!', 'success')
     return redirect(url_for('items.detail', item_id=item_id))
 
@@ -225,15 +249,21 @@ def delete(item_id):
         flash('You can only delete your own items.', 'error')
         return redirect(url_for('items.detail', item_id=item_id))
     
-    # Delete image file if exists
-    if item.image_filename:
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], item.image_filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+    image_filename = item.image_filename
+    
+    # Its messages go with it, and unread ones leave the receivers' counters
+    for receiver_id, count in db.session.query(Message.receiver_id, db.func.count(Message.id))\
+            .filter(Message.item_id == item.id, Message.is_read == db.false())\
+            .group_by(Message.receiver_id):
+        unread.adjust(receiver_id, -count)
     
     db.session.delete(item)
     db.session.commit()
     
+    # Delete image file and its resized copies in the background
+    if image_filename:
+        jobs.enqueue('delete_image', image_filename, delay=current_app.config['IMAGE_DELETE_DELAY'])
+    
     flash('Item deleted successfully.', 'info')
     return redirect(url_for('items.browse'))
 
@@ -242,12 +272,29 @@ def delete(item_id):
 @login_required
 def dashboard():
     """User's personal dashboard showing their items"""
-    # Get user's items
-    lost_items = Item.query.filter_by(user_id=current_user.id, status='lost')\
-        .order_by(Item.created_at.desc()).all()
-    found_items = Item.query.filter_by(user_id=current_user.id, status='found')\
-        .order_by(Item.created_at.desc()).all()
+    per_page = current_app.config['ITEMS_PER_PAGE']
+    columns = (Item.created_at, Item.id)
+    
+    # Get user's items, one page of each status
+    try:
+        lost_items = keyset_paginate(
+            user_items(current_user.id, 'lost'), columns,
+            cursor=request.args.get('lost_cursor'), per_page=per_page)
+        found_items = keyset_paginate(
+            user_items(current_user.id, 'found'), columns,
+            cursor=request.args.get('found_cursor'), per_page=per_page)
+    except CursorError:
+        abort(400)
+    
+    # Per-status totals for the summary cards
+    counts = dict(user_status_counts(current_user.id).all())
+    
+    # Best candidates for the user's open items, posted by other people
+    matches = matches_for_user(current_user.id)
     
     return render_template('dashboard.html',
                          lost_items=lost_items,
-                         found_items=found_items)
+                         found_items=found_items,
+                         lost_count=counts.get('lost', 0),
+                         found_count=counts.get('found', 0),
+                         matches=matches)
@@ -2,10 +2,13 @@
 Message routes
 Handles messaging between users about items
 """
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, abort
 from flask_login import login_required, current_user
-from app import db
-from app.models import Message, User, Item
+from app import db, unread, conversations, events
+from app.models import Message, User, Item, Conversation, ConversationParticipant
+from app.pagination import keyset_paginate, CursorError
+from app.queries import (inbox_messages, sent_messages, message_or_404, items_with_owner,
+                         conversation_list, thread_messages)
 
 bp = Blueprint('messages', __name__, url_prefix='/messages')
 
@@ -14,12 +17,18 @@ bp = Blueprint('messages', __name__, url_prefix='/messages')
 @login_required
 def inbox():
     """View user's inbox"""
-    # Get all received messages
-    messages = Message.query.filter_by(receiver_id=current_user.id)\
-        .order_by(Message.created_at.desc()).all()
+    # Get one page of received messages
+    try:
+        messages = keyset_paginate(
+            inbox_messages(current_user.id),
+            (Message.created_at, Message.id),
+            cursor=request.args.get('cursor'),
+            per_page=current_app.config['MESSAGES_PER_PAGE'])
+    except CursorError:
+        abort(400)
     
-    # Count unread messages
-    unread_count = Message.query.filter_by(receiver_id=current_user.id, is_read=False).count()
+    # Unread count is kept on the user row
+    unread_count = unread.unread_count_for(current_user)
     
     return render_template('messages/inbox.html', messages=messages, unread_count=unread_count)
 
@@ -28,8 +37,14 @@ def inbox():
 @login_required
 def sent():
     """View user's sent messages"""
-    messages = Message.query.filter_by(sender_id=current_user.id)\
-        .order_by(Message.created_at.desc()).all()
+    try:
+        messages = keyset_paginate(
+            sent_messages(current_user.id),
+            (Message.created_at, Message.id),
+            cursor=request.args.get('cursor'),
+            per_page=current_app.config['MESSAGES_PER_PAGE'])
+    except CursorError:
+        abort(400)
     
     return render_template('messages/sent.html', messages=messages)
 
@@ -61,7 +76,7 @@ def compose():
             flash('You cannot send a message to yourself.', 'error')
             return render_template('messages/compose.html')
         
-        # Create message
+        # Create message (a new message starts a new conversation)
         message = Message(
             subject=subject,
             body=body,
@@ -69,8 +84,8 @@ def compose():
             receiver_id=receiver.id,
             item_id=int(item_id) if item_id else None
         )
-        
-        db.session.add(message)
+        conversation = conversations.start(current_user.id, receiver.id, subject, message.item_id)
+        conversations.add_message(conversation, message)
         db.session.commit()
         
         flash('Message sent successfully!', 'success')
@@ -82,7 +97,7 @@ def compose():
     
     item = None
     if item_id:
-        item = Item.query.get(item_id)
+        item = items_with_owner().filter_by(id=item_id).first()
     
     return render_template('messages/compose.html', 
                          item=item,
@@ -93,7 +108,7 @@ def compose():
 @login_required
 def view(message_id):
     """View a specific message"""
-    message = Message.query.get_or_404(message_id)
+    message = message_or_404(message_id)
     
     # Check if user is sender or receiver
     if message.sender_id != current_user.id and message.receiver_id != current_user.id:
@@ -102,7 +117,7 @@ def view(message_id):
     
     # Mark as read if receiver is viewing
     if message.receiver_id == current_user.id and not message.is_read:
-        message.is_read = True
+        unread.mark_read(message)
         db.session.commit()
     
     return render_template('messages/view.html', message=message)
@@ -112,7 +127,7 @@ def view(message_id):
 @login_required
 def reply(message_id):
     """Reply to a message"""
-    original_message = Message.query.get_or_404(message_id)
+    original_message = message_or_404(message_id)
     
     # Check if user can reply (must be receiver of original)
     if original_message.receiver_id != current_user.id:
@@ -126,7 +141,7 @@ def reply(message_id):
             flash('Message body cannot be empty.', 'error')
             return render_template('messages/reply.html', original_message=original_message)
         
-        # Create reply
+        # Create reply in the same conversation
         reply_message = Message(
             subject=f"Re: {original_message.subject}",
             body=body,
@@ -134,8 +149,9 @@ def reply(message_id):
             receiver_id=original_message.sender_id,
             item_id=original_message.item_id
         )
-        
-        db.session.add(reply_message)
+        conversation = original_message.conversation or conversations.start(
+            original_message.sender_id, current_user.id, original_message.subject, original_message.item_id)
+        conversations.add_message(conversation, reply_message)
         db.session.commit()
         
         flash('Reply sent successfully!', 'success')
@@ -155,8 +171,84 @@ def delete(message_id):
         flash('You do not have permission to delete this message.', 'error')
         return redirect(url_for('messages.inbox'))
     
+    # Deleting an unread message also removes it from the receiver's count
+    if not message.is_read:
+        unread.adjust(message.receiver_id, -1)
+    conversation_id = message.conversation_id
     db.session.delete(message)
+    db.session.flush()
+    if conversation_id:
+        conversations.refresh(conversation_id)
     db.session.commit()
     
     flash('Message deleted.', 'info')
     return redirect(url_for('messages.inbox'))
+
+
+@bp.route('/events')
+@login_required
+def event_stream():
+    """Server-Sent Events with the user's unread count and new messages"""
+    if events.get_broker() is None:
+        abort(404)
+    body = events.stream(current_user.id, unread.unread_count_for(current_user))
+    return current_app.response_class(body, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Let nginx pass events through unbuffered
+    })
+
+
+@bp.route('/conversations')
+@login_required
+def conversation_index():
+    """List the user's conversations, most recently active first"""
+    try:
+        page = keyset_paginate(
+            conversation_list(current_user.id),
+            (ConversationParticipant.last_message_at, ConversationParticipant.conversation_id),
+            cursor=request.args.get('cursor'),
+            per_page=current_app.config['MESSAGES_PER_PAGE'])
+    except CursorError:
+        abort(400)
+    
+    return render_template('messages/conversations.html', participations=page)
+
+
+@bp.route('/conversations/<int:conversation_id>', methods=['GET', 'POST'])
+@login_required
+def thread(conversation_id):
+    """Show a conversation and add messages to it"""
+    if request.method == 'POST':
+        body = request.form.get('body')
+        receiver_id = conversations.other_participant_id(conversation_id, current_user.id)
+        if receiver_id is None:
+            abort(404)
+        
+        if not body:
+            flash('Message body cannot be empty.', 'error')
+        else:
+            conversation = Conversation.query.get_or_404(conversation_id)
+            message = Message(
+                subject=f"Re: {conversation.subject}",
+                body=body,
+                sender_id=current_user.id,
+                receiver_id=receiver_id,
+                item_id=conversation.item_id
+            )
+            conversations.add_message(conversation, message)
+            db.session.commit()
+        return redirect(url_for('messages.thread', conversation_id=conversation_id))
+    
+    # Reading the thread reads every message in it (before loading, so the
+    # commit does not expire the loaded messages)
+    if conversations.mark_read(conversation_id, current_user.id):
+        db.session.commit()
+    
+    # One query loads the whole thread (and checks the user takes part in it)
+    messages = thread_messages(conversation_id, current_user.id).all()
+    if not messages:
+        abort(404)
+    
+    return render_template('messages/thread.html',
+                         conversation=messages[0].conversation,
+                         messages=messages)
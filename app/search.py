@@ -0,0 +1,175 @@
+"""
+Full-text search for items
+Backs the browse page with an SQLite FTS5 index (or a Postgres tsvector
+index) instead of scanning the items table with ILIKE
+"""
+import re
+import click
+from flask.cli import with_appcontext
+from app import db
+
+# Words in a search query (anything else is treated as a separator)
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Column weights used for ranking: title, location, description
+TITLE_WEIGHT = 10.0
+LOCATION_WEIGHT = 5.0
+DESCRIPTION_WEIGHT = 1.0
+
+# SQLite: external-content FTS5 table over items, kept in sync by triggers.
+# Resolved items are left out of the index so it stays sized to open items
+# (a NULL is_resolved counts as open). Updates of other columns, such as
+# updated_at, do not touch the index.
+SQLITE_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        title, location, description,
+        content='items', content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items
+    WHEN coalesce(new.is_resolved, 0) = 0 BEGIN
+        INSERT INTO items_fts(rowid, title, location, description)
+        VALUES (new.id, new.title, coalesce(new.location, ''), new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items
+    WHEN coalesce(old.is_resolved, 0) = 0 BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, location, description)
+        VALUES ('delete', old.id, old.title, coalesce(old.location, ''), old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_update
+    AFTER UPDATE OF title, location, description, is_resolved ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, location, description)
+        SELECT 'delete', old.id, old.title, coalesce(old.location, ''), old.description
+        WHERE coalesce(old.is_resolved, 0) = 0;
+        INSERT INTO items_fts(rowid, title, location, description)
+        SELECT new.id, new.title, coalesce(new.location, ''), new.description
+        WHERE coalesce(new.is_resolved, 0) = 0;
+    END
+    """,
+]
+
+# Postgres: weighted tsvector expression, served by a GIN index
+PG_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(items.title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(items.location, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(items.description, '')), 'D')"
+)
+
+PG_SCHEMA = [
+    f"CREATE INDEX IF NOT EXISTS ix_items_search ON items USING gin (({PG_DOCUMENT}))",
+]
+
+
+def _backend():
+    """Return 'sqlite', 'postgresql' or None when no index is available"""
+    name = db.engine.dialect.name
+    if name in ('sqlite', 'postgresql'):
+        return name
+    return None
+
+
+def _terms(search_query):
+    """Split a raw search string into lowercase words"""
+    return [term.lower() for term in WORD_RE.findall(search_query or '')]
+
+
+def init_app(app):
+    """Register the CLI command (the index itself is created by a migration)"""
+    app.cli.add_command(reindex_command)
+
+
+def create_index(conn):
+    """Create the search index, filling it the first time it is created"""
+    backend = conn.dialect.name
+    if backend == 'sqlite':
+        exists = conn.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='items_fts'"
+        )).first()
+        for statement in SQLITE_SCHEMA:
+            conn.execute(db.text(statement))
+        if not exists:
+            _fill_index(conn)
+    elif backend == 'postgresql':
+        for statement in PG_SCHEMA:
+            conn.execute(db.text(statement))
+
+
+def _fill_index(conn):
+    """Replace the SQLite index contents with the open items"""
+    conn.execute(db.text("INSERT INTO items_fts(items_fts) VALUES ('delete-all')"))
+    conn.execute(db.text(
+        "INSERT INTO items_fts(rowid, title, location, description) "
+        "SELECT id, title, coalesce(location, ''), description FROM items "
+        "WHERE coalesce(is_resolved, 0) = 0"
+    ))
+
+
+def rebuild_index():
+    """Rebuild the search index from the items table"""
+    if _backend() != 'sqlite':
+        # The Postgres expression index is maintained by the database itself
+        return
+    with db.engine.begin() as conn:
+        _fill_index(conn)
+
+
+def search_items(query, search_query):
+    """
+    Restrict an Item query to rows matching search_query.
+    Every word must match; the last word also matches as a prefix, so
+    partially typed queries still find results.
+    Returns (query, rank) where rank sorts best matches first in ascending
+    order, or None when no full-text index is available.
+    """
+    from app.models import Item
+
+    terms = _terms(search_query)
+    if not terms:
+        return query, None
+
+    backend = _backend()
+    if backend == 'sqlite':
+        match = ' '.join(f'"{term}"' for term in terms[:-1])
+        match = f'{match} "{terms[-1]}"*'.strip()
+        hits = db.text(
+            "SELECT rowid AS item_id, "
+            f"bm25(items_fts, {TITLE_WEIGHT}, {LOCATION_WEIGHT}, {DESCRIPTION_WEIGHT}) AS rank "
+            "FROM items_fts WHERE items_fts MATCH :match"
+        ).bindparams(match=match).columns(item_id=db.Integer, rank=db.Float).subquery('search_hits')
+        # bm25() is already lower-is-better. The "+ 0" stops SQLite from
+        # probing the index once per item by rowid, which it otherwise picks
+        # for the result count: the MATCH has to drive the join.
+        return query.join(hits, Item.id == hits.c.item_id + 0), hits.c.rank
+
+    if backend == 'postgresql':
+        tsquery = ' & '.join(terms[:-1] + [f'{terms[-1]}:*'])
+        document = db.literal_column(f'({PG_DOCUMENT})')
+        matches = db.func.to_tsquery('english', tsquery)
+        rank = -db.func.ts_rank(document, matches)
+        return query.filter(document.op('@@')(matches)), rank
+
+    # No full-text support: fall back to substring matching on every word
+    for term in terms:
+        pattern = f'%{term}%'
+        query = query.filter(db.or_(
+            Item.title.ilike(pattern),
+            Item.description.ilike(pattern),
+            Item.location.ilike(pattern)
+        ))
+    return query, None
+
+
+@click.command('search-reindex')
+@with_appcontext
+def reindex_command():
+    """Rebuild the item search index"""
+    rebuild_index()
+    click.echo('Search index rebuilt.')
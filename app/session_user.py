@@ -0,0 +1,93 @@
+"""
+Session user cache
+Flask-Login's user_loader runs on every authenticated request. Instead of
+loading a full User row each time, keep a small immutable snapshot of the
+fields pages actually read, in a bounded per-process LRU with a TTL.
+Snapshots are dropped as soon as a change to the user is committed.
+"""
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import db
+from app.cache import LRUCache
+from app.models import User
+
+
+class SessionUser:
+    """Read-only stand-in for User used as current_user"""
+    
+    __slots__ = ('id', 'username', 'email', 'full_name', 'phone', 'created_at')
+    
+    # Flask-Login interface
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+    
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+    
+    @classmethod
+    def from_user(cls, user):
+        return cls(**{name: getattr(user, name) for name in cls.__slots__})
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('SessionUser is read-only; load the User row to change it')
+    
+    def get_id(self):
+        return str(self.id)
+    
+    def __eq__(self, other):
+        return isinstance(other, (SessionUser, User)) and other.get_id() == self.get_id()
+    
+    def __hash__(self):
+        return hash(self.id)
+    
+    def __repr__(self):
+        return f'<SessionUser {self.username}>'
+
+
+def _cache():
+    return current_app.extensions['session_users']
+
+
+def load_user(user_id):
+    """user_loader: return a cached snapshot, loading the user on a miss"""
+    cache = _cache()
+    snapshot = cache.get(user_id)
+    if snapshot is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = SessionUser.from_user(user)
+        cache.set(user_id, snapshot, current_app.config['USER_CACHE_TTL'])
+    return snapshot
+
+
+def invalidate(user_id):
+    """Forget the snapshot of a user"""
+    _cache().delete(user_id)
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_user_changes(session, flush_context, instances):
+    """Remember which users this transaction changes or deletes"""
+    changed = {obj.id for obj in session.dirty | session.deleted if isinstance(obj, User)}
+    if changed:
+        session.info.setdefault('users_changed', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    for user_id in session.info.pop('users_changed', ()):
+        invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('users_changed', None)
+
+
+def init_app(app):
+    """Create the per-process snapshot cache"""
+    app.extensions['session_users'] = LRUCache(app.config['USER_CACHE_SIZE'])
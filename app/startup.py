@@ -0,0 +1,45 @@
+"""
+Cold start measurement
+Every web worker imports the app and runs create_app() before it can serve
+a request, so start-up time is paid on each deploy, restart and scale-up.
+`flask boot-time` measures it in fresh interpreters, and fails if booting
+imported multiprocessing: process pools (password hashing) start on first
+use, so no worker or CLI command forks just to start.
+"""
+import os
+import statistics
+import subprocess
+import sys
+import click
+
+# Run in a fresh interpreter: import the app and build it, print the seconds
+# and whether multiprocessing got imported on the way
+BOOT_SCRIPT = (
+    'import sys, time; start = time.perf_counter(); '
+    'from app import create_app; create_app({config!r}); '
+    'print(time.perf_counter() - start, "multiprocessing" in sys.modules)'
+)
+
+
+def init_app(app):
+    app.cli.add_command(boot_time_command)
+
+
+@click.command('boot-time')
+@click.option('--runs', default=5, help='Number of cold starts to measure.')
+@click.option('--config', 'config_name', default='production', help='Configuration to start with.')
+def boot_time_command(runs, config_name):
+    """Measure how long a new worker takes to import and create the app"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = BOOT_SCRIPT.format(config=config_name)
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', script], cwd=root,
+                                capture_output=True, text=True, check=True)
+        seconds, multiprocessing = result.stdout.strip().splitlines()[-1].split()
+        if multiprocessing == 'True':
+            raise click.ClickException('create_app() imported multiprocessing; '
+                                       'process pools must start on first use')
+        timings.append(float(seconds) * 1000)
+    click.echo(f'cold start ({config_name}): median {statistics.median(timings):.0f} ms, '
+               f'min {min(timings):.0f} ms, max {max(timings):.0f} ms over {runs} runs')
@@ -68,6 +68,26 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
+    // Live unread count and new-message notices (Server-Sent Events)
+    const eventsUrl = document.body.dataset.eventsUrl;
+    if (eventsUrl && window.EventSource) {
+        const events = new EventSource(eventsUrl);
+        events.addEventListener('unread', function(e) {
+            updateUnreadBadge(JSON.parse(e.data).count);
+        });
+        events.addEventListener('message', function(e) {
+            showMessageNotice(JSON.parse(e.data));
+        });
+    }
+    
+    // Typeahead suggestions for fields marked with data-suggest
+    const suggestUrl = document.body.dataset.suggestUrl;
+    document.querySelectorAll('input[data-suggest]').forEach(function(input) {
+        if (suggestUrl && !input.readOnly) {
+            attachSuggestions(input, suggestUrl);
+        }
+    });
+    
     // Search form auto-submit on filter change (optional)
     const filterSelects = document.querySelectorAll('select[name="status"], select[name="category"]');
     filterSelects.forEach(function(select) {
@@ -78,6 +98,70 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
+// Show the unread count in the navigation badge (hidden at zero)
+function updateUnreadBadge(count) {
+    const badge = document.getElementById('unread-badge');
+    if (!badge) {
+        return;
+    }
+    badge.textContent = count;
+    badge.style.display = count > 0 ? '' : 'none';
+}
+
+// Briefly show a link to a message that just arrived
+function showMessageNotice(message) {
+    const notice = document.createElement('a');
+    notice.href = message.url;
+    notice.className = 'fixed bottom-4 right-4 bg-blue-600 text-white px-4 py-3 rounded-lg shadow-lg';
+    notice.textContent = 'New message: ' + message.subject;
+    document.body.appendChild(notice);
+    setTimeout(function() {
+        notice.style.opacity = '0';
+        notice.style.transition = 'opacity 0.5s';
+        setTimeout(function() {
+            notice.remove();
+        }, 500);
+    }, 8000);
+}
+
+// Fill a <datalist> for an input from /suggest, 150 ms after typing stops
+function attachSuggestions(input, suggestUrl) {
+    const list = document.createElement('datalist');
+    list.id = (input.id || input.name) + '-suggestions';
+    input.setAttribute('list', list.id);
+    input.parentElement.appendChild(list);
+    
+    let timer = null;
+    let pending = null;
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            const prefix = input.value.trim();
+            if (!prefix) {
+                list.innerHTML = '';
+                return;
+            }
+            // Only the answer for the latest text matters
+            if (pending) {
+                pending.abort();
+            }
+            pending = new AbortController();
+            const url = suggestUrl + '?kind=' + input.dataset.suggest + '&q=' + encodeURIComponent(prefix);
+            fetch(url, { signal: pending.signal, credentials: 'same-origin' })
+                .then(function(response) { return response.ok ? response.json() : []; })
+                .then(function(suggestions) {
+                    list.innerHTML = '';
+                    suggestions.forEach(function(suggestion) {
+                        const option = document.createElement('option');
+                        option.value = suggestion;
+                        list.appendChild(option);
+                    });
+                })
+                .catch(function() {});
+        }, 150);
+    });
+}
+
 // Utility function to format dates
 function formatDate(dateString) {
     const date = new Date(dateString);
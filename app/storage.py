@@ -0,0 +1,266 @@
+"""
+Upload storage
+Uploaded images are stored under the SHA-256 digest of their contents, in a
+sharded layout (ab/cd/abcd....jpg). Identical uploads share one blob, names
+never collide, and a stored blob never changes, so its URL can be cached
+forever. A blob is deleted only once no item refers to it, IMAGE_DELETE_DELAY
+after the last one let go of it.
+
+Blobs live in a pluggable backend chosen by STORAGE_BACKEND: the local
+upload folder, or an S3-compatible bucket (AWS S3, MinIO, ...). Images of
+archived items move to a second, cold backend configured by COLD_STORAGE.
+`flask storage-check` round-trips a few blobs through the configured backend,
+e.g. against a local MinIO before pointing the app at a real bucket.
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import tempfile
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.datastructures import FileStorage
+
+# Bytes read from a stream at a time
+CHUNK_SIZE = 64 * 1024
+
+# Uploads up to this size are buffered in memory while being hashed
+SPOOL_SIZE = 1024 * 1024
+
+# Extensions that mean the same format share one canonical spelling
+CANONICAL_EXTENSIONS = {'jpeg': 'jpg'}
+
+# Stored blobs never change, so clients and CDNs may keep them forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class LocalStorage:
+    """Blobs stored as files under a local folder, served by main.upload"""
+
+    def __init__(self, folder, url_prefix='/uploads'):
+        self.folder = folder
+        self.url_prefix = url_prefix
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def put(self, name, fileobj):
+        """Write a blob from a file object, replacing it atomically"""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(fileobj, out, CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, name):
+        """Open a blob for reading"""
+        return open(self.path(name), 'rb')
+
+    def delete(self, name):
+        """Delete a blob if it exists"""
+        path = self.path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def url(self, name):
+        return f'{self.url_prefix}/{name}'
+
+
+class S3Storage:
+    """
+    Blobs stored in an S3-compatible bucket.
+    One client per process is shared by all threads, so connections are
+    pooled; large uploads and downloads are split into parallel multipart
+    transfers.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 public_url=None, max_pool_connections=20,
+                 multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024,
+                 storage_class=None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config as BotoConfig
+        except ImportError as exc:
+            raise RuntimeError('STORAGE_BACKEND = "s3" requires boto3 (pip install boto3)') from exc
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.storage_class = storage_class
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=BotoConfig(max_pool_connections=max_pool_connections,
+                              retries={'max_attempts': 5, 'mode': 'standard'}),
+        )
+        self.transfer = TransferConfig(multipart_threshold=multipart_threshold,
+                                       multipart_chunksize=multipart_chunksize,
+                                       max_concurrency=max(1, max_pool_connections // 2))
+        if public_url:
+            self.public_url = public_url.rstrip('/')
+        elif endpoint_url:
+            self.public_url = f'{endpoint_url.rstrip("/")}/{bucket}'
+        else:
+            self.public_url = f'https://{bucket}.s3.amazonaws.com'
+
+    def key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def put(self, name, fileobj):
+        """Upload a blob, using a multipart upload above the threshold"""
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        extra = {'ContentType': content_type, 'CacheControl': IMMUTABLE_CACHE_CONTROL}
+        if self.storage_class:
+            extra['StorageClass'] = self.storage_class
+        self.client.upload_fileobj(fileobj, self.bucket, self.key(name),
+                                   ExtraArgs=extra, Config=self.transfer)
+
+    def open(self, name):
+        """Download a blob into a seekable temporary file"""
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self.client.download_fileobj(self.bucket, self.key(name), spool,
+                                     Config=self.transfer)
+        spool.seek(0)
+        return spool
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def exists(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def url(self, name):
+        return f'{self.public_url}/{self.key(name)}'
+
+
+def create_storage(config):
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'], config.get('UPLOAD_URL_PREFIX', '/uploads'))
+    if backend == 's3':
+        return S3Storage(
+            config['S3_BUCKET'],
+            prefix=config.get('S3_PREFIX') or '',
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            public_url=config.get('S3_PUBLIC_URL'),
+            max_pool_connections=config.get('S3_MAX_POOL_CONNECTIONS', 20),
+            multipart_threshold=config.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024),
+            multipart_chunksize=config.get('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024),
+            storage_class=config.get('S3_STORAGE_CLASS'),
+        )
+    raise ValueError(f'Unknown STORAGE_BACKEND: {backend}')
+
+
+def init_app(app):
+    """Create the storage backends for the app"""
+    app.extensions['storage'] = create_storage(app.config)
+    # Cold storage: the same settings with COLD_STORAGE's overrides
+    app.extensions['cold_storage'] = create_storage(dict(app.config, **app.config['COLD_STORAGE']))
+    app.cli.add_command(check_command)
+
+
+def get_storage():
+    """The storage backend of the current app"""
+    return current_app.extensions['storage']
+
+
+def get_cold_storage():
+    """The storage backend for images of archived items"""
+    return current_app.extensions['cold_storage']
+
+
+def blob_name(digest, extension):
+    """Relative name of a blob, e.g. 'ab/cd/abcd...ef.jpg'"""
+    extension = CANONICAL_EXTENSIONS.get(extension, extension)
+    return f'{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+
+def save_upload(file, storage=None):
+    """
+    Store an uploaded file (in hot storage unless another backend is given),
+    hashing it while it is read.
+    Returns the blob name it is stored under; if the same content is already
+    stored the new copy is discarded.
+    """
+    storage = storage or get_storage()
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    digest = hashlib.sha256()
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+        while True:
+            chunk = file.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            spool.write(chunk)
+
+        name = blob_name(digest.hexdigest(), extension)
+        if not storage.exists(name):
+            spool.seek(0)
+            storage.put(name, spool)
+    return name
+
+
+def reference_count(name):
+    """Number of items that use a stored image"""
+    from app.models import Item
+    return Item.query.filter_by(image_filename=name).count()
+
+
+@click.command('storage-check')
+@click.option('--cold', is_flag=True, help='Check the cold storage backend instead.')
+@with_appcontext
+def check_command(cold):
+    """Store, deduplicate, read back and delete test blobs in the configured backend"""
+    storage = get_cold_storage() if cold else get_storage()
+    click.echo(f'Checking {type(storage).__name__} ...')
+
+    def check(ok, what):
+        if not ok:
+            raise click.ClickException(f'{what}: failed')
+        click.echo(f'  {what}: ok')
+
+    small = os.urandom(64 * 1024)
+    # Above the multipart threshold, so S3 splits it into parts
+    large = os.urandom(current_app.config.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024) + 1)
+    names = []
+    try:
+        for label, data in (('small blob', small), ('multipart blob', large)):
+            name = save_upload(FileStorage(stream=io.BytesIO(data), filename='storage-check.png'), storage)
+            names.append(name)
+            check(storage.exists(name), f'{label} stored')
+            with storage.open(name) as stream:
+                check(stream.read() == data, f'{label} read back')
+
+        again = save_upload(FileStorage(stream=io.BytesIO(small), filename='storage-check.png'), storage)
+        check(again == names[0], 'identical upload deduplicated')
+    finally:
+        for name in names:
+            storage.delete(name)
+    check(not any(storage.exists(name) for name in names), 'blobs deleted')
+    click.echo(f'Example URL: {storage.url(names[0])}')
+
@@ -0,0 +1,272 @@
+"""
+Typeahead suggestions
+In-memory prefix indexes over open items' titles, their locations and
+usernames back the /suggest endpoint used by the search, location and
+recipient fields. Each index is a sorted list of (key, value) pairs
+searched with bisect, with every value filed under each of its word starts,
+so "lib" finds "Main Library". Values are normalized (case and whitespace),
+and the most used ones come first. A lookup only looks at the first
+SUGGEST_SCAN_LIMIT entries under the prefix, in key order, so for very short
+prefixes the ranking covers those entries rather than every match.
+Commits in this process update the indexes straight away. Changes made by
+other processes are picked up through items.updated_at and new user ids
+every SUGGEST_REFRESH_SECONDS, and a full reload every
+SUGGEST_REBUILD_SECONDS drops items deleted elsewhere. Both run in a
+background thread, one at a time, while requests keep using the current
+index; only the first load of a process makes requests wait.
+"""
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import db
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('items', 'locations', 'users')
+
+# Word starts a value is filed under; later words of long titles are not
+MAX_KEYS = 8
+
+
+def normalize(text):
+    """Lookup form of a value: lower case, single spaces"""
+    return ' '.join((text or '').casefold().split())
+
+
+def _keys(value):
+    words = value.split(' ')
+    return {' '.join(words[i:]) for i in range(min(len(words), MAX_KEYS))}
+
+
+class PrefixIndex:
+    """Sorted (key, value) pairs with a use count per value; not thread-safe on its own"""
+
+    def __init__(self, scan_limit=500):
+        self.scan_limit = scan_limit
+        self.entries = []          # Sorted (key, value) pairs
+        self.counts = Counter()    # value -> number of rows using it
+        self.display = {}          # value -> text shown (first spelling seen)
+        self.sorted = True         # False while loading: entries are sorted once by finish()
+
+    def add(self, text):
+        value = normalize(text)
+        if not value:
+            return
+        if not self.counts[value]:
+            self.display[value] = ' '.join(text.split())
+            for key in _keys(value):
+                if self.sorted:
+                    insort(self.entries, (key, value))
+                else:
+                    self.entries.append((key, value))
+        self.counts[value] += 1
+
+    def finish(self):
+        """Sort the entries appended while loading"""
+        self.entries.sort()
+        self.sorted = True
+
+    def remove(self, text):
+        value = normalize(text)
+        if not self.counts.get(value):
+            return
+        self.counts[value] -= 1
+        if self.counts[value]:
+            return
+        del self.counts[value]
+        del self.display[value]
+        for key in _keys(value):
+            i = bisect_left(self.entries, (key, value))
+            if i < len(self.entries) and self.entries[i] == (key, value):
+                del self.entries[i]
+
+    def suggest(self, prefix, limit):
+        """
+        Up to limit values with a word starting with prefix, most used first
+        among the first scan_limit entries for the prefix
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        start = bisect_left(self.entries, (prefix,))
+        end = min(bisect_left(self.entries, (prefix + '\uffff',)), start + self.scan_limit)
+        values = {value for _, value in self.entries[start:end]}
+        best = heapq.nsmallest(limit, values, key=lambda value: (-self.counts[value], len(value), value))
+        return [self.display[value] for value in best]
+
+
+class SuggestIndex:
+    """The three prefix indexes, and what each item and user put into them"""
+
+    def __init__(self, scan_limit=500):
+        self.scan_limit = scan_limit
+        self.indexes = {kind: PrefixIndex(scan_limit) for kind in KINDS}
+        self.items = {}              # item id -> (title, location) indexed for it
+        self.users = {}              # user id -> username
+        self.item_watermark = None   # Newest items.updated_at seen
+        self.loaded_at = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    def suggest(self, kind, prefix, limit):
+        with self._lock:
+            return self.indexes[kind].suggest(prefix, limit)
+
+    def set_item(self, item_id, title, location, is_open):
+        """Index an item's title and location, replacing what it had before"""
+        with self._lock:
+            old = self.items.pop(item_id, None)
+            if old is not None:
+                self.indexes['items'].remove(old[0])
+                self.indexes['locations'].remove(old[1])
+            if is_open:
+                self.items[item_id] = (title, location)
+                self.indexes['items'].add(title)
+                self.indexes['locations'].add(location)
+
+    def set_user(self, user_id, username):
+        """Index a user's name; username None removes the user"""
+        with self._lock:
+            old = self.users.pop(user_id, None)
+            if old is not None:
+                self.indexes['users'].remove(old)
+            if username is not None:
+                self.users[user_id] = username
+                self.indexes['users'].add(username)
+
+    def _load_items(self, query):
+        for row in query.yield_per(1000):
+            self.set_item(row.id, row.title, row.location, not row.is_resolved)
+            if row.updated_at and (self.item_watermark is None or row.updated_at > self.item_watermark):
+                self.item_watermark = row.updated_at
+
+    def _load_users(self, query):
+        for row in query.yield_per(1000):
+            self.set_user(row.id, row.username)
+
+    def _item_query(self):
+        from app.models import Item
+        return db.session.query(Item.id, Item.title, Item.location, Item.is_resolved, Item.updated_at)
+
+    def load(self):
+        """Read every open item and every user"""
+        from app.models import Item, User
+        for index in self.indexes.values():
+            index.sorted = False
+        self._load_items(self._item_query().filter(Item.is_resolved.is_(False)))
+        self._load_users(db.session.query(User.id, User.username))
+        for index in self.indexes.values():
+            index.finish()
+        self.loaded_at = self.refreshed_at = time.monotonic()
+
+    def refresh(self):
+        """Apply items changed and users added since the last refresh"""
+        from app.models import Item, User
+        query = self._item_query()
+        if self.item_watermark is None:
+            query = query.filter(Item.is_resolved.is_(False))
+        else:
+            # >= so rows sharing the watermark's timestamp are not missed
+            query = query.filter(Item.updated_at >= self.item_watermark)
+        self._load_items(query)
+        newest_user = max(self.users, default=0)
+        self._load_users(db.session.query(User.id, User.username).filter(User.id > newest_user))
+        self.refreshed_at = time.monotonic()
+
+
+def _maintain(app):
+    """Load, reload or refresh the app's index as due; called with the app's suggest lock held"""
+    config = app.config
+    index = app.extensions['suggest_index']
+    now = time.monotonic()
+    if index.loaded_at is None or now - index.loaded_at > config['SUGGEST_REBUILD_SECONDS']:
+        # Build a new index while requests keep using the old one
+        fresh = SuggestIndex(config['SUGGEST_SCAN_LIMIT'])
+        fresh.load()
+        app.extensions['suggest_index'] = fresh
+    elif now - index.refreshed_at > config['SUGGEST_REFRESH_SECONDS']:
+        index.refresh()
+
+
+def _maintain_in_background(app):
+    lock = app.extensions['suggest_lock']
+    try:
+        with app.app_context():
+            _maintain(app)
+    except Exception:
+        # The current index keeps serving; the next request tries again
+        logger.exception('Could not update the suggest index')
+    finally:
+        lock.release()
+
+
+def get_suggest_index():
+    """Suggest index of the current app, loaded on first use and kept up to date"""
+    app = current_app._get_current_object()
+    config = app.config
+    lock = app.extensions['suggest_lock']
+    index = app.extensions['suggest_index']
+
+    if index.loaded_at is None:
+        # Nothing to serve yet: one request loads the index, the others wait for it
+        with lock:
+            _maintain(app)
+        return app.extensions['suggest_index']
+
+    now = time.monotonic()
+    due = (now - index.loaded_at > config['SUGGEST_REBUILD_SECONDS']
+           or now - index.refreshed_at > config['SUGGEST_REFRESH_SECONDS'])
+    if due and lock.acquire(blocking=False):
+        threading.Thread(target=_maintain_in_background, args=(app,),
+                         name='suggest-refresh', daemon=True).start()
+    return index
+
+
+# Changes committed in this process go straight into the index
+
+@event.listens_for(Session, 'after_flush')
+def _track_changes(session, flush_context):
+    from app.models import Item, User
+    changes = session.info.setdefault('suggest_changes', [])
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Item):
+            changes.append(('item', obj.id, (obj.title, obj.location, not obj.is_resolved)))
+        elif isinstance(obj, User):
+            changes.append(('user', obj.id, obj.username))
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            changes.append(('item', obj.id, (None, None, False)))
+        elif isinstance(obj, User):
+            changes.append(('user', obj.id, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('suggest_changes', None)
+    if not changes or not has_app_context():
+        return
+    index = current_app.extensions.get('suggest_index')
+    if index is None or index.loaded_at is None:
+        return
+    for kind, row_id, values in changes:
+        if kind == 'item':
+            index.set_item(row_id, *values)
+        else:
+            index.set_user(row_id, values)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('suggest_changes', None)
+
+
+def init_app(app):
+    """Create the (empty) suggest index and the lock that serializes its updates"""
+    app.extensions['suggest_index'] = SuggestIndex(app.config.get('SUGGEST_SCAN_LIMIT', 500))
+    app.extensions['suggest_lock'] = threading.Lock()
@@ -0,0 +1,66 @@
+"""
+Background tasks
+Slow side effects of item routes, run by the job queue in app/jobs.py
+"""
+from app import db
+from app.cache import bump_items_version
+from app.jobs import task
+from app.images import process_image, delete_variants
+from app.storage import get_storage, reference_count
+
+
+@task('process_item_image')
+def process_item_image(item_id, image_filename):
+    """Write resized copies of an item's image and record them on the item"""
+    from app.models import Item
+    
+    storage = get_storage()
+    
+    # Identical uploads share one blob, so reuse variants made for another item
+    done = Item.query.filter(Item.image_filename == image_filename,
+                             Item.image_formats.isnot(None)).first()
+    if done:
+        image_formats, image_placeholder = done.image_formats, done.image_placeholder
+    else:
+        image_formats, image_placeholder = process_image(storage, image_filename)
+    
+    # Only record the result if the item still uses this image
+    updated = Item.query.filter_by(id=item_id, image_filename=image_filename)\
+        .update({Item.image_formats: image_formats,
+                 Item.image_placeholder: image_placeholder},
+                synchronize_session=False)
+    db.session.commit()
+    if updated:
+        # Listing pages embed the image URLs, so drop cached copies
+        bump_items_version()
+    elif not reference_count(image_filename):
+        delete_variants(storage, image_filename)
+
+
+@task('delete_image')
+def delete_image(image_filename):
+    """
+    Remove an uploaded image and all of its resized copies, unless still in use.
+    Queued IMAGE_DELETE_DELAY after the image went out of use: save_upload
+    reuses a stored blob without writing it again, so an identical upload
+    that is about to be saved has that long to be committed and counted here.
+    """
+    if reference_count(image_filename):
+        return
+    storage = get_storage()
+    storage.delete(image_filename)
+    delete_variants(storage, image_filename)
+
+
+@task('match_item')
+def match_item(item_id):
+    """Recompute an item's possible matches (see app/matching.py)"""
+    from app.matching import update_matches
+    update_matches(item_id)
+
+
+@task('match_all')
+def match_all():
+    """Recompute possible matches for every open item"""
+    from app.matching import rematch_all
+    rematch_all()
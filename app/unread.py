@@ -0,0 +1,109 @@
+"""
+Unread message counters
+Each user's unread count is stored on the users row and adjusted in the
+same transaction as the message change, so pages never need to COUNT the
+messages table. The count is read once per request; it is not cached
+across requests, since a cache in one worker process would go stale when
+another one changes the count.
+"""
+import click
+from flask import g, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db
+from app.models import User, Message
+
+
+def adjust(user_id, delta):
+    """
+    Add delta to a user's unread count as part of the current transaction.
+    A count already read in this request is dropped once it commits.
+    """
+    db.session.query(User).filter_by(id=user_id)\
+        .update({User.unread_count: User.unread_count + delta},
+                synchronize_session=False)
+    db.session.info.setdefault('unread_dirty', set()).add(user_id)
+
+
+def mark_read(message):
+    """
+    Mark a message read and decrement the receiver's count, at most once
+    even if the same message is opened by two requests at the same time
+    """
+    updated = Message.query.filter_by(id=message.id, is_read=False)\
+        .update({Message.is_read: True}, synchronize_session=False)
+    if updated:
+        adjust(message.receiver_id, -1)
+    set_committed_value(message, 'is_read', True)
+    return bool(updated)
+
+
+def _read_count(user):
+    """Counter value from a loaded User, or from the database for a SessionUser"""
+    count = getattr(user, 'unread_count', None)
+    if count is None:
+        count = db.session.query(User.unread_count).filter_by(id=user.id).scalar()
+    return count or 0
+
+
+def unread_count_for(user):
+    """Unread message count for a user, read at most once per request (ETag and badge)"""
+    counts = g.setdefault('unread_counts', {})
+    if user.id not in counts:
+        counts[user.id] = _read_count(user)
+    return counts[user.id]
+
+
+def invalidate(user_id=None):
+    """Forget the count read in this request for one user, or for everyone"""
+    counts = g.get('unread_counts') if has_app_context() else None
+    if not counts:
+        return
+    if user_id is None:
+        counts.clear()
+    else:
+        counts.pop(user_id, None)
+
+
+def unread_query(receiver_id):
+    """Count of unread messages for receiver_id (a user id, or User.id to correlate)"""
+    # "= false" rather than "IS false" so the partial unread index applies
+    return db.session.query(db.func.count(Message.id))\
+        .filter(Message.receiver_id == receiver_id, Message.is_read == db.false())
+
+
+def rebuild_counts():
+    """Recompute every user's unread count from the messages table"""
+    unread = unread_query(User.id).scalar_subquery()
+    db.session.query(User).update({User.unread_count: unread},
+                                  synchronize_session=False)
+    db.session.commit()
+    invalidate()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    """Drop counts read earlier in the request for users whose counter changed"""
+    for user_id in session.info.pop('unread_dirty', ()):
+        invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('unread_dirty', None)
+
+
+def init_app(app):
+    """Expose the counter to templates and register the repair command"""
+    app.jinja_env.globals['unread_count_for'] = unread_count_for
+    app.cli.add_command(repair_command)
+
+
+@click.command('repair-unread-counts')
+@with_appcontext
+def repair_command():
+    """Rebuild unread message counters from the messages table"""
+    rebuild_counts()
+    click.echo('Unread counters rebuilt.')
@@ -19,17 +19,141 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'instance', 'lost_found.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    
+    # Apply pending schema migrations at start-up instead of with `flask migrate`
+    AUTO_MIGRATE = False
+    
+    # Applied to every new SQLite connection (ignored for other databases)
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',        # Readers no longer block the writer
+        'synchronous': 'NORMAL',      # fsync at checkpoints only; safe with WAL
+        'busy_timeout': 5000,         # Wait up to 5s for a lock instead of failing
+        'cache_size': -64000,         # 64MB page cache per connection
+        'mmap_size': 268435456,       # Read the database through a 256MB memory map
+        'temp_store': 'MEMORY',
+    }
+    
+    # Read replicas (comma-separated URLs); reads on READ_REPLICA_ROUTES go to them
+    DATABASE_REPLICA_URLS = [url.strip() for url in
+                             os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    # Endpoints or whole blueprints that only read
+    READ_REPLICA_ROUTES = {'main.index', 'items.browse', 'items.detail',
+                           'messages.inbox', 'messages.sent', 'api'}
+    # After writing, a visitor reads from the primary for this many seconds
+    REPLICA_STICKY_SECONDS = 10
     
     # Upload folder configuration
     UPLOAD_FOLDER = os.path.join(basedir, 'app', 'static', 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # Uploads are content-addressed, so cache for a year
+    IMAGE_DELETE_DELAY = 10 * 60  # Seconds an unused image is kept, in case an identical upload reuses it
+    
+    # Upload storage backend: 'local' (UPLOAD_FOLDER) or 's3' (needs boto3)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'local'
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = os.environ.get('S3_PREFIX') or 'uploads'
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL')  # CDN or bucket URL images are served from
+    S3_MAX_POOL_CONNECTIONS = 20
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    S3_STORAGE_CLASS = None  # e.g. 'STANDARD_IA'; None uses the bucket default
+    
+    # Cold storage for images of archived items: overrides of the settings above
+    COLD_STORAGE = {
+        'UPLOAD_FOLDER': os.path.join(basedir, 'instance', 'cold-uploads'),
+        'UPLOAD_URL_PREFIX': '/archive/uploads',  # Served by main.archived_upload
+        'S3_PREFIX': 'cold',
+        'S3_STORAGE_CLASS': os.environ.get('COLD_S3_STORAGE_CLASS') or 'STANDARD_IA',
+    }
+    
+    # Resolved items are moved to items_archive this long after being resolved
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+    ARCHIVE_BATCH_SIZE = 500  # Items moved per transaction
+    
+    # Password hashing (werkzeug method string, including its cost parameters).
+    # Hashes made with a different method are upgraded on the next login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = 2  # Hashing processes per app process; 0 hashes on the request thread
+    PASSWORD_HASH_MAX_PENDING = 16  # Logins allowed to wait for a worker before returning 503
+    PASSWORD_HASH_WAIT_TIMEOUT = 2.0  # Seconds to wait for a free slot
     
     # Session configuration
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
     
     # Pagination
     ITEMS_PER_PAGE = 12
+    MESSAGES_PER_PAGE = 20
+    PAGINATION_COUNT_CAP = 1000  # Result counts above this are shown as "1000+"
+    
+    # JSON API (/api/v1)
+    API_PER_PAGE = 50
+    API_MAX_PER_PAGE = 200
+    API_GZIP_MIN_SIZE = 1024  # Smaller responses are not worth compressing
+    API_GZIP_LEVEL = 6
+    
+    # Debug mode fails any request that runs more SQL queries than this
+    QUERY_COUNT_LIMIT = 20
+    
+    # Request metrics in Prometheus format (app/metrics.py)
+    METRICS_ENABLED = True
+    METRICS_PATH = '/metrics'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # Bearer token; without one /metrics is off outside debug
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Seconds
+    
+    # Sampling profiler: stacks of requests slower than PROFILE_SLOW_MS go to PROFILE_DIR
+    PROFILE_SLOW_REQUESTS = os.environ.get('PROFILE_SLOW_REQUESTS', '').lower() in ('1', 'true', 'yes')
+    PROFILE_SLOW_MS = int(os.environ.get('PROFILE_SLOW_MS', 500))
+    PROFILE_INTERVAL_MS = 5
+    PROFILE_DIR = os.path.join(basedir, 'instance', 'profiles')
+    
+    # Logged-in user snapshots cached per process by the Flask-Login user_loader
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300  # Seconds
+    
+    # Page cache for anonymous visitors ('memory', or 'redis' to share across workers)
+    CACHE_ENABLED = True
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'memory'
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or 'redis://localhost:6379/0'
+    CACHE_MAX_ENTRIES = 512
+    CACHE_DEFAULT_TTL = 60  # Seconds; also bounds staleness between workers without Redis
+    
+    # Seconds browsers and proxies may reuse an anonymous page before revalidating it
+    HTTP_CACHE_MAX_AGE = 0
+    
+    # Live unread counts over Server-Sent Events ('memory', or 'redis' to reach
+    # streams held by other workers). Off by default: each open tab holds a
+    # worker thread, so only turn it on under gevent or gunicorn --threads
+    EVENTS_ENABLED = os.environ.get('EVENTS_ENABLED', '').lower() in ('1', 'true', 'yes')
+    EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND') or 'memory'
+    EVENTS_REDIS_URL = os.environ.get('EVENTS_REDIS_URL') or 'redis://localhost:6379/0'
+    EVENTS_HEARTBEAT = 15      # Seconds between keep-alive comments
+    EVENTS_MAX_AGE = 300       # Seconds before a stream ends and the browser reconnects
+    EVENTS_RETRY_MS = 5000     # Browser reconnect delay
+    EVENTS_QUEUE_SIZE = 100    # Events buffered per stream before it misses some
+    EVENTS_REDIS_TIMEOUT = 1.0 # Seconds a Redis publish may take before the event is dropped
+    
+    # Typeahead suggestions for search, location and recipient fields (app/suggest.py)
+    SUGGEST_LIMIT = 8                # Suggestions returned unless ?limit= asks for fewer or more (max 20)
+    SUGGEST_CACHE_SECONDS = 30       # Browsers may reuse a suggestion list this long
+    SUGGEST_REFRESH_SECONDS = 5      # How often changes made by other processes are picked up
+    SUGGEST_REBUILD_SECONDS = 3600   # Full reload, which also drops items deleted elsewhere
+    SUGGEST_SCAN_LIMIT = 500         # Entries ranked per lookup, in key order (bounds short prefixes)
+    
+    # Lost-to-found matching (app/matching.py)
+    MATCH_TOP_K = 5               # Matches kept per item
+    MATCH_DATE_WINDOW_DAYS = 14   # Items further apart in time never match
+    MATCH_MIN_SCORE = 0.2         # 0-1; weaker candidates are not stored
+    
+    # Background jobs (image processing, file cleanup)
+    JOB_QUEUE_PATH = os.path.join(basedir, 'instance', 'jobs.db')
+    JOB_WORKERS = 2  # Worker threads per process; 0 to use 'flask jobs-work' instead
+    JOB_MAX_ATTEMPTS = 3
+    JOB_LEASE_SECONDS = 300  # A running job is retried elsewhere if its worker is silent this long
+    JOB_RUN_INLINE = False  # Run jobs immediately inside the request (tests, debugging)
     
     # Application settings
     APP_NAME = 'Campus Lost & Found'
@@ -39,11 +163,21 @@ class Config:
 class DevelopmentConfig(Config):
     """Development configuration"""
     DEBUG = True
+    AUTO_MIGRATE = True
 
 
 class ProductionConfig(Config):
     """Production configuration"""
     DEBUG = False
+    
+    # Connection pool for server databases (Postgres)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': 10,       # Seconds to wait for a free connection
+        'pool_pre_ping': True,    # Replace connections the server has dropped
+        'pool_recycle': 1800,     # Reconnect every 30 minutes
+    }
 
 
 # Configuration dictionary
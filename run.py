@@ -6,8 +6,9 @@ Run this file to start the development server
 import os
 from app import create_app
 
-# Create the Flask application
-app = create_app('development')
+# Create the Flask application (FLASK_ENV=production on deployed servers, which
+# never migrate on start-up: run "flask --app run migrate" when deploying)
+app = create_app(os.environ.get('FLASK_ENV') or 'development')
 
 if __name__ == '__main__':
     # Get port from environment variable or use 5000